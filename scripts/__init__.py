@@ -1 +1,54 @@
-import country_lookup
+"""
+Frequency estimation from sequence metadata, importable from the repository root
+- aggregation: scan_metadata, aggregate_tensor, CountTensor, count_cube,
+  read_count_cube, update_count_cube, count_delta, apply_count_delta,
+  read_store
+- single category fits: fit_single_categories, single_category_systems,
+  frequency_table
+- hierarchical fits: fit_hierarchical_table, fit_hierarchical_arrays
+- population weighting: read_population_table, write_population_table,
+  population_weighted_frequencies, population_weighted_plan, prepare_data,
+  weighted_average
+
+e.g. `from scripts import aggregate_tensor, fit_hierarchical_table`. The names
+are resolved on first use, so importing the package (or running one of its
+scripts with `python -m scripts.<name>`) only loads the modules needed.
+"""
+
+from importlib import import_module
+
+_api = {
+    "scan_metadata": "fit_single_frequencies",
+    "aggregate_tensor": "fit_single_frequencies",
+    "CountTensor": "fit_single_frequencies",
+    "fit_single_categories": "fit_single_frequencies",
+    "single_category_systems": "fit_single_frequencies",
+    "frequency_table": "fit_single_frequencies",
+    "count_cube": "aggregate_counts",
+    "read_count_cube": "aggregate_counts",
+    "update_count_cube": "aggregate_counts",
+    "count_delta": "aggregate_counts",
+    "apply_count_delta": "aggregate_counts",
+    "read_store": "aggregate_counts",
+    "fit_hierarchical_table": "fit_hierarchical_frequencies",
+    "fit_hierarchical_arrays": "fit_hierarchical_frequencies",
+    "read_population_table": "pop_weighted_aggregates",
+    "write_population_table": "pop_weighted_aggregates",
+    "population_weighted_frequencies": "pop_weighted_aggregates",
+    "population_weighted_plan": "pop_weighted_aggregates",
+    "prepare_data": "pop_weighted_aggregates",
+    "weighted_average": "pop_weighted_aggregates",
+}
+
+__all__ = list(_api)
+
+
+def __getattr__(name):
+    if name not in _api:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module("." + _api[name], __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_api))
@@ -0,0 +1,342 @@
+"""
+Script to aggregate sequence counts once per dataset into a count cube
+- counts per geographic categories, frequency category, variant and day
+- several frequency categories (clade columns and mutations) in one file
+- stored as a long table in Arrow IPC format with categorical columns
+- totals follow from summing the counts of a category over its variants
+
+The fit scripts accept the cube via `--counts` instead of `--metadata`.
+
+With `--store`, the cube is kept in a directory together with an index of
+the counted strains and updated from batches of new or changed records and
+strains to remove, instead of being recounted from scratch. The index
+(SQLite, keyed by strain name) is only queried and updated for the strains
+of a batch, and the change in counts of the batch is appended as a delta
+file, so an update does not depend on the number of strains counted before
+nor on the size of the cube. The index records which deltas are committed,
+together with the strains; every few batches the deltas are folded into a
+new base cube. Reading the store adds the deltas to the base cube.
+"""
+
+import os
+import sqlite3
+
+import polars as pl
+
+from . import profiling
+from .fit_single_frequencies import mutation_categories, scan_metadata
+
+
+def count_cube(d, geo_categories, categories, min_date=None):
+    """
+    Count sequences of `d` by geographic categories, date and variant for
+    each column in `categories`. Returns a long table with columns
+    geo_categories..., category, variant, date and count.
+    """
+    d = d.filter(~pl.col('date').is_null())
+    if min_date:
+        d = d.filter(pl.col('date')>=pl.lit(min_date).str.strptime(pl.Date, format="%Y-%m-%d"))
+
+    cube = pl.concat([
+        d.filter(~pl.col(category).is_null())
+         .group_by(geo_categories + ["date", category]).count()
+         .select([pl.col(x).cast(pl.Utf8) for x in geo_categories] +
+                 [pl.lit(category).alias("category"), pl.col(category).cast(pl.Utf8).alias("variant"),
+                  "date", pl.col("count").cast(pl.UInt32)])
+        for category in categories
+    ])
+    return _sort_cube(cube, geo_categories)
+
+def _sort_cube(cube, geo_categories):
+    return cube.sort(["category", "variant"] + geo_categories + ["date"]).with_columns(
+        [pl.col(x).cast(pl.Categorical) for x in geo_categories + ["category", "variant"]])
+
+def count_delta(batch, old, geo_categories, categories, min_date=None):
+    """
+    Change in counts from a `batch` of new or changed records and the `old`
+    records of changed and removed strains as they were counted (columns of
+    `strain_records`), which are subtracted. Only the records are counted, so
+    this does not depend on the size of the cube. Returns a long table with
+    the columns of the cube and a signed column delta, without zero changes.
+    """
+    keys = geo_categories + ["category", "variant", "date"]
+    def signed(x, sign):
+        return x.select([pl.col(k).cast(pl.Utf8) for k in keys[:-1]] + ["date", pl.col("count").cast(pl.Int64)*sign])
+
+    return (pl.concat([signed(count_cube(batch, geo_categories, categories, min_date=min_date), 1),
+                       signed(count_cube(old, geo_categories, categories, min_date=min_date), -1)])
+              .group_by(keys).agg(pl.col("count").sum().alias("delta"))
+              .filter(pl.col("delta")!=0))
+
+def apply_count_delta(cube, delta, geo_categories):
+    """
+    Join a `delta` from `count_delta`, or several of them concatenated, on the
+    cells of a count `cube`. Cells that drop to zero are removed. This reads
+    the whole cube. Returns the updated cube.
+    """
+    keys = geo_categories + ["category", "variant", "date"]
+    delta = delta.group_by(keys).agg(pl.col("delta").sum()).filter(pl.col("delta")!=0)
+    if len(delta)==0:
+        return cube
+
+    cells = cube.with_columns([pl.col(k).cast(pl.Utf8) for k in keys[:-1]])
+    updated = (cells.join(delta, on=keys, how="left")
+                    .select(keys + [(pl.col("count").cast(pl.Int64) + pl.col("delta").fill_null(0)).alias("count")]))
+    added = delta.join(cells, on=keys, how="anti").select(keys + [pl.col("delta").alias("count")])
+    cube = pl.concat([updated, added]).filter(pl.col("count")>0).with_columns(pl.col("count").cast(pl.UInt32))
+    # new cells have to be sorted in, otherwise the order of the cube is kept
+    if len(added):
+        return _sort_cube(cube, geo_categories)
+    return cube.with_columns([pl.col(x).cast(pl.Categorical) for x in geo_categories + ["category", "variant"]])
+
+def update_count_cube(cube, batch, old, geo_categories, categories, min_date=None):
+    """
+    Update a count `cube` in memory with a `batch` of new or changed records,
+    subtracting the `old` records of changed and removed strains (see
+    `count_delta` and `apply_count_delta`). The cost is linear in the size of
+    the cube. Returns the updated cube.
+    """
+    return apply_count_delta(cube, count_delta(batch, old, geo_categories, categories, min_date=min_date),
+                             geo_categories)
+
+def strain_records(d, geo_categories, categories):
+    """
+    The columns of `d` that enter the count cube, one row per strain.
+    """
+    return d.select([pl.col("strain").cast(pl.Utf8)] + [pl.col(x).cast(pl.Utf8) for x in geo_categories] +
+                    ["date"] + [pl.col(x).cast(pl.Utf8) for x in categories])
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def open_strain_index(store, geo_categories, categories):
+    """
+    Connection to the index of the strains counted in the store directory
+    `store`, one row per strain with the columns of `strain_records`, created
+    if missing. The index also records the generations of the count files
+    (see `store_generation`). Raises a ValueError if the store was built for
+    other geographic or frequency categories.
+    """
+    columns = ["strain"] + geo_categories + ["date"] + categories
+    os.makedirs(os.path.join(store, "deltas"), exist_ok=True)
+    db = sqlite3.connect(os.path.join(store, "strains.sqlite"))
+    db.execute(f"CREATE TABLE IF NOT EXISTS strains ({', '.join(_quote(x) + ' TEXT' for x in columns)}, "
+               "PRIMARY KEY (strain)) WITHOUT ROWID")
+    db.execute("CREATE TABLE IF NOT EXISTS generations (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    db.execute("INSERT OR IGNORE INTO generations VALUES ('base', 0), ('head', 0)")
+    db.commit()
+    existing = [row[1] for row in db.execute("PRAGMA table_info(strains)")]
+    if existing!=columns:
+        db.close()
+        raise ValueError(f"count store {store} has columns {existing}, expected {columns}")
+    return db
+
+def store_generation(db):
+    """
+    Generations of the count files of a store with the index `db`: the cube
+    `counts-{base}.arrow` holds the counts up to delta `base` and the deltas
+    `deltas/{n}.arrow` for base < n <= head have to be added to it. Files of
+    other generations are left over from interrupted updates and ignored.
+    """
+    values = dict(db.execute("SELECT name, value FROM generations").fetchall())
+    return values["base"], values["head"]
+
+def _base_path(store, generation):
+    return os.path.join(store, f"counts-{generation:06d}.arrow")
+
+def _delta_path(store, generation):
+    return os.path.join(store, "deltas", f"{generation:06d}.arrow")
+
+def _write_replace(df, path):
+    df.write_ipc(path + ".tmp", compression="zstd")
+    os.replace(path + ".tmp", path)
+
+def counted_records(db, strains, geo_categories, categories):
+    """
+    Records of the `strains` in the index `db` as they were counted, looked
+    up by name. Strains that are not in the index are skipped.
+    """
+    columns = ["strain"] + geo_categories + ["date"] + categories
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (strain TEXT PRIMARY KEY)")
+    db.execute("DELETE FROM lookup")
+    db.executemany("INSERT OR IGNORE INTO lookup VALUES (?)", ((x,) for x in strains))
+    rows = db.execute(f"SELECT {', '.join('strains.' + _quote(x) for x in columns)} "
+                      "FROM lookup JOIN strains USING (strain)").fetchall()
+    old = pl.DataFrame(rows, schema={x: pl.Utf8 for x in columns}, orient="row")
+    return old.with_columns(pl.col("date").str.strptime(pl.Date, format="%Y-%m-%d"))
+
+def _empty_cube(geo_categories, categories):
+    columns = ["strain"] + geo_categories + ["date"] + categories
+    empty = pl.DataFrame({x: [] for x in columns}, schema={x: pl.Date if x=="date" else pl.Utf8 for x in columns})
+    return count_cube(empty, geo_categories, categories)
+
+def _combine_store(store, base, head, geo_categories, categories):
+    cube = pl.read_ipc(_base_path(store, base), memory_map=False) if base else _empty_cube(geo_categories, categories)
+    if head==base:
+        return cube
+    deltas = pl.concat([pl.read_ipc(_delta_path(store, n), memory_map=False) for n in range(base + 1, head + 1)])
+    return apply_count_delta(cube, deltas, geo_categories)
+
+def read_store(store, geo_categories, categories):
+    """
+    Count cube of the store directory `store`: the base cube plus the deltas
+    committed after it. Empty if the store does not exist yet.
+    """
+    if not os.path.exists(os.path.join(store, "strains.sqlite")):
+        return _empty_cube(geo_categories, categories)
+    db = open_strain_index(store, geo_categories, categories)
+    try:
+        base, head = store_generation(db)
+        return _combine_store(store, base, head, geo_categories, categories)
+    finally:
+        db.close()
+
+def compact_store(store, geo_categories, categories):
+    """
+    Fold the deltas of the store directory `store` into a new base cube. The
+    new generation is committed to the index before the files it replaces
+    are deleted, so an interrupted compaction leaves a readable store.
+    Returns the cube.
+    """
+    db = open_strain_index(store, geo_categories, categories)
+    try:
+        base, head = store_generation(db)
+        cube = _combine_store(store, base, head, geo_categories, categories)
+        if head==base:
+            return cube
+        _write_replace(cube, _base_path(store, head))
+        db.execute("UPDATE generations SET value = ? WHERE name = 'base'", (head,))
+        db.commit()
+    finally:
+        db.close()
+    for name in os.listdir(store):
+        if name.startswith("counts-") and name.endswith(".arrow") and name!=os.path.basename(_base_path(store, head)):
+            os.remove(os.path.join(store, name))
+    for name in os.listdir(os.path.join(store, "deltas")):
+        if name.endswith(".arrow") and int(name.split(".")[0])<=head:
+            os.remove(os.path.join(store, "deltas", name))
+    return cube
+
+def ingest_batch(store, batch, removed, geo_categories, categories, min_date=None, compact_every=32):
+    """
+    Update the store directory `store` with a `batch` of new or changed
+    records and a list of `removed` strain names. Changed and removed strains
+    are subtracted with the values they were counted with, so ingesting the
+    same batch twice leaves the store unchanged. Only the strains of the
+    batch are looked up and written in the index, and their change in counts
+    is written as a new delta file, so an update does not read the cube. The
+    delta and the index are committed together in one transaction. Every
+    `compact_every` deltas, the store is compacted (see `compact_store`).
+    Returns the change in counts and the number of records that were replaced
+    or removed.
+    """
+    batch = strain_records(batch, geo_categories, categories).unique("strain", keep="last", maintain_order=True)
+    db = open_strain_index(store, geo_categories, categories)
+    try:
+        base, head = store_generation(db)
+        old = counted_records(db, batch.get_column("strain").to_list() + list(removed), geo_categories, categories)
+        delta = count_delta(batch, old, geo_categories, categories, min_date=min_date)
+
+        db.executemany("DELETE FROM strains WHERE strain = ?", ((x,) for x in removed))
+        db.executemany(f"INSERT OR REPLACE INTO strains VALUES ({', '.join('?'*len(batch.columns))})",
+                       batch.with_columns(pl.col("date").cast(pl.Utf8)).iter_rows())
+        # a delta of an interrupted update was never committed and is overwritten
+        if len(delta):
+            head += 1
+            _write_replace(delta, _delta_path(store, head))
+            db.execute("UPDATE generations SET value = ? WHERE name = 'head'", (head,))
+        db.commit()
+    finally:
+        db.close()
+    if compact_every and head - base>=compact_every:
+        compact_store(store, geo_categories, categories)
+    return delta, len(old)
+
+def read_count_cube(path, category, geo_categories):
+    """
+    Read the counts of one frequency category from a count cube in the row
+    format of the metadata: one column per geographic category, the variant
+    in a column named after `category`, the date and the count.
+    """
+    return count_rows(pl.read_ipc(path, memory_map=False), category, geo_categories, name=path)
+
+def count_rows(cube, category, geo_categories, name="count cube"):
+    """
+    Counts of one frequency category of an in-memory count `cube`, in the row
+    format of `read_count_cube`. Other geographic categories of the cube are
+    dropped, `aggregate_tensor` sums their rows.
+    """
+    missing = [x for x in geo_categories if x not in cube.columns]
+    if missing:
+        raise ValueError(f"{name} has no geographic categories {missing}")
+    cube = cube.filter(pl.col("category")==category)
+    if len(cube)==0:
+        raise ValueError(f"{name} has no frequency category {category}")
+
+    return cube.select([pl.col(x).cast(pl.Utf8) for x in geo_categories] +
+                       [pl.col("variant").cast(pl.Utf8).alias(category), "date", "count"])
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--metadata", type=str, help="filename with metadata, optionally compressed (.gz, .xz, .zst)")
+    parser.add_argument("--frequency-categories", nargs='*', default=[], type=str, help="fields to use for frequency categories")
+    parser.add_argument("--mutations", nargs='*', default=[], type=str, help="mutations or comma separated mutation combinations to count")
+    parser.add_argument("--geo-categories", nargs='+', type=str, help="fields to use for geographic categories")
+    parser.add_argument("--min-date", type=str, help="drop sequences before this date")
+    parser.add_argument("--output", type=str, help="file for the count cube (Arrow IPC)")
+    parser.add_argument("--store", type=str, help="directory with a count cube, its deltas and the counted strains "
+                        "(strains.sqlite) to update with the records in --metadata instead of counting from scratch; "
+                        "with --output, the updated cube is written there")
+    parser.add_argument("--compact-every", type=int, default=32, help="fold the deltas of the store into a new cube "
+                        "once there are this many")
+    parser.add_argument("--remove", type=str, help="file with names of strains to remove from the store, one per line")
+    parser.add_argument("--profile-json", type=str, help="write timing and memory of the stages to this json file")
+
+    args = parser.parse_args()
+    if args.profile_json:
+        profiling.enable()
+    categories = args.frequency_categories + args.mutations
+
+    columns = args.geo_categories + args.frequency_categories + ['date']
+    if args.store:
+        columns.insert(0, "strain")
+    if args.mutations:
+        columns.append("aaSubstitutions")
+    # dates are parsed while scanning, so reading includes the date parsing
+    profiling.mark("read")
+    if args.metadata:
+        # in store mode records before min_date are kept in the strain table but not counted
+        d = scan_metadata(args.metadata, columns, min_date=None if args.store else args.min_date).collect()
+    else:
+        d = pl.DataFrame({x: [] for x in columns}, schema={x: pl.Date if x=="date" else pl.Utf8 for x in columns})
+    if args.mutations:
+        d = mutation_categories(d, args.mutations)
+    profiling.count("rows_read", len(d))
+
+    if args.store:
+        removed = []
+        if args.remove:
+            with open(args.remove) as fh:
+                removed = [line.strip() for line in fh if line.strip()]
+        profiling.mark("update")
+        delta, n_replaced = ingest_batch(args.store, d, removed, args.geo_categories, categories,
+                                         min_date=args.min_date, compact_every=args.compact_every)
+        profiling.count("changed_cells", len(delta))
+        print(f"{len(d)} records and {len(removed)} removals ingested, {n_replaced} counted strains replaced or removed, "
+              f"{len(delta)} cells changed")
+        if args.output:
+            profiling.mark("write")
+            cube = read_store(args.store, args.geo_categories, categories)
+            cube.write_ipc(args.output, compression="zstd")
+            profiling.count("cells", len(cube))
+            print(f"{len(cube)} non-zero cells for {len(categories)} categories")
+    else:
+        profiling.mark("aggregate")
+        cube = count_cube(d, args.geo_categories, categories, min_date=args.min_date)
+        profiling.mark("write")
+        cube.write_ipc(args.output, compression="zstd")
+        profiling.count("cells", len(cube))
+        print(f"{len(cube)} non-zero cells for {len(categories)} categories")
+    profiling.write(args.profile_json)
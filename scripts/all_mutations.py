@@ -1,8 +1,9 @@
 import polars as  pl
 from datetime import datetime
 import numpy as np
-from fit_single_frequencies import fit_single_category, load_and_aggregate
+from .fit_single_frequencies import aggregate_tensor, fit_single_categories
 from collections import defaultdict
+from . import profiling
 
 if __name__=='__main__':
     import argparse
@@ -14,13 +15,19 @@ if __name__=='__main__':
     parser.add_argument("--max-date", type=str, help="date to end frequency calculation")
     parser.add_argument("--cutoff", type=float, default=0.1)
     parser.add_argument("--output", type=str, help="file for json output")
+    parser.add_argument("--profile-json", type=str, help="write timing and memory of the stages to this json file")
 
     args = parser.parse_args()
     stiffness = 500/args.days
+    if args.profile_json:
+        profiling.enable()
 
+    profiling.mark("read")
     d = pl.read_csv(args.metadata, separator='\t', try_parse_dates=False, columns=["region", "aaSubstitutions", 'date'])
     d = d.filter((pl.col('date')>=args.min_date)&(pl.col('date')<args.max_date))
+    profiling.count("rows_read", len(d))
 
+    profiling.mark("select_mutations")
     mutation_count_by_year = defaultdict(int)
     sequence_count_by_year = defaultdict(int)
 
@@ -54,27 +61,26 @@ if __name__=='__main__':
     d = d.with_columns(new_columns + [pl.col('date').apply(lambda x:'dummy').alias('dummy'),
                         pl.col("date").str.strptime(pl.Date, format="%Y-%m-%d", strict=False)])
 
+    profiling.count("mutations", len(mutations_to_keep))
+
+    profiling.mark("fit")
     frequencies = {}
     traj_counts = {}
     for mut in mutations_to_keep:
         print(mut)
-        data, tmp_totals, counts, time_bins = load_and_aggregate(d, ['dummy'], mut,
-                                                    bin_size=args.days, min_date=args.min_date)
-
-        geo_label = 'dummy'
-        totals = {k[-1]:v for k,v in tmp_totals.items() if k[0]==geo_label}
-        sub_counts = {}
-        for fcat in counts.keys():
-            sub_counts[fcat] = {k[-1]:v for k,v in counts[fcat].items() if k[0]==geo_label}
-            freqs, A = fit_single_category(totals, sub_counts[fcat],
-                                           sorted(time_bins.keys()), stiffness=stiffness)
-
-            if max([x['val'] for x in freqs.values()])>args.cutoff and min([x['val'] for x in freqs.values()])<1-args.cutoff:
-                frequencies[fcat] = freqs
-                traj_counts[fcat] = [(sub_counts[fcat].get(ti,0), totals.get(ti,0)) for ti in time_bins]
+        data, tensor = aggregate_tensor(d, ['dummy'], mut, bin_size=args.days, min_date=args.min_date)
+
+        # a single geographic unit, all variants of the mutation are fitted in one batch
+        totals, counts = tensor.totals[0], tensor.counts[0]
+        vals, _, _ = fit_single_categories(totals, counts, stiffness=stiffness)
+        for fcat, val, fcat_counts in zip(tensor.variants, vals, counts):
+            if val.max()>args.cutoff and val.min()<1-args.cutoff:
+                frequencies[fcat] = list(val)
+                traj_counts[fcat] = list(zip(fcat_counts, totals))
                 print(len(frequencies), fcat)
 
 
+    profiling.mark("plot")
     import matplotlib.pyplot as plt
     fig, axs = plt.subplots(1,2, figsize=(12,5))
     n_pre = 720//args.days
@@ -93,7 +99,7 @@ if __name__=='__main__':
         normalized_traj = {}
         for fcat in frequencies:
             new_mut = False
-            freqs = [x['val'] for x in frequencies[fcat].values()]
+            freqs = frequencies[fcat]
             counts = traj_counts[fcat]
             for fi, f in enumerate(freqs[:-(n_past//2)]):
                 if max(freqs[fi:n_pre+fi])<0.03:
@@ -123,5 +129,6 @@ if __name__=='__main__':
     axs[1].set_xlabel('days')
 
     plt.savefig(args.output)
+    profiling.write(args.profile_json)
 
 
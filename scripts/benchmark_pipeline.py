@@ -0,0 +1,316 @@
+"""
+Script to benchmark the frequency pipeline on synthetic data
+- synthetic metadata of several sizes is generated with synthetic_metadata.py
+- each stage (reading, aggregation, single and hierarchical fits, population
+  weighting and the web conversion) is timed and its peak memory recorded
+- golden checks compare the aggregation and fits against the shipped fit
+  results (data_web/inputs/*.csv): their counts are re-aggregated and
+  refitted, and the web conversion is checked to reproduce the table; single
+  category fits trimmed to the bins with counts of each variant have to match
+  the untrimmed fits, hierarchical ones to stay close to them, and a region
+  whose countries are all pooled has to fit to NaN
+- optionally, the batched fits are compared to fits of one system at a time
+  with the original sparse solver, and the tree elimination of the
+  hierarchical fits to a sparse solve of the assembled matrix
+Writes one row per size and stage as TSV and, with --profile-json, the timers
+and counters of the fits of each size. Exits with an error if a check fails.
+"""
+
+import json
+import os
+import tempfile
+from datetime import datetime
+
+import numpy as np
+import polars as pl
+
+from . import profiling
+from .fit_hierarchical_frequencies import (fit_hierarchical_table, geo_tree, node_sums, solve_geo_tree,
+                                           sparse_geo_tree_solution)
+from .fit_single_frequencies import (CountTensor, aggregate_tensor, fit_single_categories, fit_single_category,
+                                    frequency_table, scan_metadata, single_category_systems)
+from .pop_weighted_aggregates import population_weighted_frequencies, read_population_table
+from .synthetic_metadata import synthetic_metadata
+
+
+def benchmark_size(n_sequences, work_dir, n_countries=50, n_clades=40, n_days=730, bin_size=14, seed=0,
+                   reference=False):
+    """
+    Run all stages on synthetic metadata with `n_sequences` rows and return
+    the profile summary with the stages, timers and counters of the fits.
+    With `reference`, the batched single category fits are compared to fits
+    of one system at a time and the hierarchical fits to sparse solves.
+    """
+    stages = profiling.enable()
+    min_date = "2022-01-01"
+    path = os.path.join(work_dir, f"metadata_{n_sequences}.tsv")
+    with stages.stage("generate") as info:
+        d = synthetic_metadata(n_sequences, n_countries=n_countries, n_clades=n_clades, n_days=n_days,
+                               min_date=min_date, seed=seed)
+        d.write_csv(path, separator='\t')
+        info["rows"] = len(d)
+    del d
+
+    with stages.stage("read") as info:
+        d = scan_metadata(path, ["region", "iso3", "proposedSubclade", "date"], min_date=min_date).collect()
+        info["rows"] = len(d)
+
+    with stages.stage("aggregate_region") as info:
+        _, region_tensor = aggregate_tensor(d, ["region"], "proposedSubclade", min_date=min_date, bin_size=bin_size,
+                                            inclusive_clades="flu")
+        info["rows"] = region_tensor.counts.size
+    with stages.stage("aggregate_country") as info:
+        _, country_tensor = aggregate_tensor(d, ["region", "iso3"], "proposedSubclade", min_date=min_date,
+                                             bin_size=bin_size, inclusive_clades="flu")
+        info["rows"] = country_tensor.counts.size
+    del d
+
+    stiffness = 5000/bin_size
+    with stages.stage("fit_single") as info:
+        systems, sys_counts, sys_totals = single_category_systems(region_tensor)
+        val, lower, upper = fit_single_categories(sys_totals, sys_counts, stiffness=stiffness)
+        frequency_table(region_tensor.dates, [s[0] for s in systems], None, [s[1] for s in systems],
+                        sys_counts, sys_totals, val, lower, upper)
+        info["rows"] = len(systems)
+    if reference:
+        with stages.stage("fit_single_reference") as info:
+            for si in range(len(systems)):
+                check_close(f"single category fit of {systems[si]}", [val[si], lower[si], upper[si]],
+                            reference_single_fit(sys_totals[si], sys_counts[si], stiffness), atol=1e-8)
+            info["rows"] = len(systems)
+
+    with stages.stage("fit_hierarchical") as info:
+        fits = fit_hierarchical_table(country_tensor, stiffness, stiffness, 5.0)
+        info["rows"] = len(fits)
+    if reference:
+        with stages.stage("fit_hierarchical_reference") as info:
+            info["rows"] = check_geo_trees(country_tensor, stiffness, stiffness, 5.0)
+
+    with stages.stage("weighted_average") as info:
+        weighted = population_weighted_frequencies(fits, read_population_table("defaults/iso3_to_pop.tsv",
+                                                                               "profiles/flu/iso3_to_region.tsv"))
+        info["rows"] = len(weighted)
+
+    from .web_convert import process_geography
+    with stages.stage("web_geography") as info, tempfile.TemporaryDirectory() as output_dir:
+        process_geography(fits.sort("date"), {"name": "synthetic"}, output_dir)
+        info["rows"] = len(fits)
+
+    os.remove(path)
+    return stages.summary(sequences=n_sequences)
+
+
+def reference_single_fit(totals, counts, stiffness):
+    """
+    (val, lower, upper) of one system from the dict interface of `fit_single_category`,
+    solved with the original sparse solve and matrix inverse as a reference for
+    the tridiagonal sweeps.
+    """
+    time_bins = range(len(totals))
+    fit, _ = fit_single_category(dict(zip(time_bins, totals)), dict(zip(time_bins, counts)), time_bins,
+                                 stiffness=stiffness, solver="sparse")
+    return [[fit[t][x] for t in time_bins] for x in ["val", "lower", "upper"]]
+
+def check_geo_trees(tensor, stiffness, stiffness_minor, mu):
+    """
+    Compare the frequencies and block variances of `solve_geo_tree` to the
+    sparse reference for every top level category and variant of the
+    `CountTensor`. Returns the number of trees compared.
+    """
+    n_trees = 0
+    for (geo_cat,), sl in tensor.geo_slices().items():
+        nodes = geo_tree(tensor.geo[sl], tensor.totals[sl].sum(axis=-1))
+        totals = node_sums(nodes, tensor.totals[sl], key="fit_units")
+        for vi, variant in enumerate(tensor.variants):
+            counts = node_sums(nodes, tensor.counts[sl, vi], key="fit_units")
+            check_close(f"hierarchical fit of {variant} in {geo_cat}",
+                        solve_geo_tree(nodes, totals, counts, stiffness, stiffness_minor, mu),
+                        sparse_geo_tree_solution(nodes, totals, counts, stiffness, stiffness_minor, mu), atol=1e-8)
+            n_trees += 1
+    return n_trees
+
+class CheckFailed(Exception):
+    pass
+
+def check_close(what, actual, expected, atol):
+    actual, expected = np.asarray(actual, dtype=float), np.asarray(expected, dtype=float)
+    if actual.shape!=expected.shape:
+        raise CheckFailed(f"{what}: shape {actual.shape} differs from {expected.shape}")
+    # values that are NaN on both sides (fits without data) agree
+    deviation = np.where(np.isnan(actual) & np.isnan(expected), 0, np.abs(actual - expected)).max(initial=0)
+    if not deviation<=atol:
+        raise CheckFailed(f"{what}: deviation {deviation:.3g} exceeds {atol:.3g}")
+    return deviation
+
+def golden_tensor(golden):
+    """
+    `CountTensor` of the countries in a fit result table, with all time bins
+    of the table. Rows of the regions themselves and of pooled countries
+    ("other") are left out, as their counts are not fitted.
+    """
+    countries = golden.filter((pl.col("country")!=pl.col("region")) & (pl.col("country")!="other"))
+    dates = sorted(golden["date"].unique())
+    geo = sorted(set(zip(countries["region"], countries["country"])))
+    variants = sorted(golden["variant"].unique())
+    geo_index = {x: i for i, x in enumerate(geo)}
+    variant_index = {x: i for i, x in enumerate(variants)}
+    date_index = {x: i for i, x in enumerate(dates)}
+
+    counts = np.zeros((len(geo), len(variants), len(dates)), dtype=np.int32)
+    totals = np.zeros((len(geo), len(dates)), dtype=np.int32)
+    gi = [geo_index[x] for x in zip(countries["region"], countries["country"])]
+    ti = [date_index[x] for x in countries["date"]]
+    counts[gi, [variant_index[x] for x in countries["variant"]], ti] = countries["count"].to_numpy()
+    totals[gi, ti] = countries["total"].to_numpy()
+    return CountTensor(geo, variants, dict(enumerate(datetime.fromisoformat(x) for x in dates)), counts, totals)
+
+def check_pooled_region(tensor, fits, stiffness, mu):
+    """
+    Refit the `CountTensor` with an extra top level category whose countries
+    all have too few sequences to be fitted on their own, so that its tree
+    has no data. Its rows have to be NaN and all other `fits` unchanged.
+    """
+    n_tp = len(tensor.dates)
+    extra_totals = np.zeros((3, n_tp), dtype=tensor.totals.dtype)
+    extra_totals[:, n_tp//2] = 10
+    extra_counts = np.zeros((3, len(tensor.variants), n_tp), dtype=tensor.counts.dtype)
+    extra_counts[:, 0, n_tp//2] = 5
+    # "~" sorts after the names of all other regions
+    pooled = CountTensor(tensor.geo + [("~pooled", f"~{i}") for i in range(3)], tensor.variants, tensor.time_bins,
+                         np.concatenate([tensor.counts, extra_counts]), np.concatenate([tensor.totals, extra_totals]))
+    refit = fit_hierarchical_table(pooled, stiffness, stiffness, mu)
+    values = ["freqMi", "freqLo", "freqUp"]
+    extra = refit.filter(pl.col("region")=="~pooled").select(values).to_numpy()
+    if not len(extra) or not np.isnan(extra).all():
+        raise CheckFailed("the rows of a region without fitted data are not NaN")
+    return check_close("fits next to a region without fitted data",
+                       refit.filter(pl.col("region")!="~pooled").select(values).to_numpy(),
+                       fits.select(values).to_numpy(), atol=1e-12)
+
+def check_golden(path, bin_size=14):
+    """
+    Check the aggregation and fits against one fit result table: the counts
+    of its countries are expanded to sequences and aggregated again, the
+    country and region frequencies are refitted with the hierarchical model,
+    the single category fits of the regions are compared to fits of one
+    region at a time and the web conversion has to reproduce the table.
+    Returns a dict with the largest deviation of each check.
+    """
+    golden = pl.read_csv(path, infer_schema_length=1_000_000).filter(pl.col("region")!="?")
+    tensor = golden_tensor(golden)
+    result = {}
+
+    # aggregation with inclusive clades from the counts of the exclusive clades
+    exclusive = [vi for vi, v in enumerate(tensor.variants) if not v.endswith("*")]
+    gi, vi, ti = np.nonzero(tensor.counts[:, exclusive])
+    records = pl.DataFrame({"region": [tensor.geo[i][0] for i in gi], "country": [tensor.geo[i][1] for i in gi],
+                            "variant": [tensor.variants[exclusive[i]] for i in vi],
+                            "date": pl.Series([tensor.dates[i] for i in ti], dtype=pl.Date),
+                            "count": tensor.counts[gi, np.array(exclusive)[vi], ti]})
+    _, aggregated = aggregate_tensor(records, ["region", "country"], "variant", min_date=tensor.dates[0].strftime("%Y-%m-%d"),
+                                     bin_size=bin_size, inclusive_clades="flu", count_column="count")
+    if aggregated.geo!=[g for g in tensor.geo if tensor.totals[tensor.geo.index(g)].sum()]:
+        raise CheckFailed(f"{path}: aggregated geographic categories differ")
+    bins = [tensor.dates.index(x) for x in aggregated.dates]
+    rows = [tensor.geo.index(g) for g in aggregated.geo]
+    result["aggregate_totals"] = check_close(f"{path}: aggregated totals", aggregated.totals,
+                                             tensor.totals[rows][:, bins], atol=0)
+    expected = tensor.select(variants=aggregated.variants).counts[rows][:, :, bins]
+    result["aggregate_counts"] = check_close(f"{path}: aggregated counts", aggregated.counts, expected, atol=0)
+
+    # hierarchical fit, the table is rounded to 4 decimals
+    fits = fit_hierarchical_table(tensor, 5000/bin_size, 5000/bin_size, 5.0)
+    joined = fits.join(golden, on=["date", "region", "country", "variant"], how="inner", suffix="_golden")
+    if len(joined)<len(fits):
+        raise CheckFailed(f"{path}: {len(fits) - len(joined)} fitted rows are not in the table")
+    for column in ["freqMi", "freqLo", "freqUp"]:
+        result[column] = check_close(f"{path}: {column}", joined[column], joined[column + "_golden"], atol=1e-4)
+    # trimming each variant to the bins with counts is approximate for the hierarchical model
+    trimmed = fit_hierarchical_table(tensor, 5000/bin_size, 5000/bin_size, 5.0, padding=4)
+    trimmed = trimmed.select(["freqMi", "freqLo", "freqUp"]).to_numpy()
+    untrimmed = fits.select(["freqMi", "freqLo", "freqUp"]).to_numpy()
+    result["trim_hierarchical"] = check_close(f"{path}: trimmed hierarchical fits", trimmed, untrimmed, atol=0.1)
+    result["trim_hierarchical_mean"] = check_close(f"{path}: mean deviation of trimmed hierarchical fits",
+                                                   np.nanmean(np.abs(trimmed - untrimmed)), 0, atol=2e-3)
+    result["pooled_region"] = check_pooled_region(tensor, fits, 5000/bin_size, 5.0)
+    # counts of "other" are not fitted and not part of the tensor
+    countries = joined.filter((pl.col("country")!=pl.col("region")) & (pl.col("country")!="other"))
+    for column in ["count", "total"]:
+        result[column] = check_close(f"{path}: {column}", countries[column], countries[column + "_golden"], atol=0)
+
+    # batched single category fits of the regions against one region at a time
+    regions = golden.filter(pl.col("country")==pl.col("region")).sort(["region", "variant", "date"])
+    n_tp = len(tensor.dates)
+    sys_counts = regions["count"].to_numpy().reshape(-1, n_tp)
+    sys_totals = regions["total"].to_numpy().reshape(-1, n_tp)
+    batched = np.array(fit_single_categories(sys_totals, sys_counts, stiffness=5000/bin_size))
+    single = np.array([reference_single_fit(n, k, 5000/bin_size) for k, n in zip(sys_counts, sys_totals)]).transpose(1, 0, 2)
+    result["fit_single"] = check_close(f"{path}: batched single category fits", batched, single, atol=1e-8)
+    # single category fits eliminate the trimmed bins exactly
+    trimmed = np.array(fit_single_categories(sys_totals, sys_counts, stiffness=5000/bin_size, padding=0))
+    result["trim_single"] = check_close(f"{path}: trimmed single category fits", trimmed, batched, atol=1e-8)
+
+    # the web conversion reproduces the values of the table, except for "other"
+    # whose files are written once per region under the same name
+    from .web_convert import process_geography
+    with tempfile.TemporaryDirectory() as output_dir:
+        process_geography(golden.sort("date"), {"name": "golden"}, output_dir)
+        converted = []
+        golden = golden.filter(pl.col("country")!="other")
+        for country in golden["country"].unique():
+            with open(os.path.join(output_dir, "pathogens", "golden", "geography", f"{country}.json")) as fh:
+                country_json = json.load(fh)
+            for x in country_json["values"]:
+                converted.extend((country_json["region"], country_json["country"], x["date"], v, x["avgs"][v],
+                                  x["ranges"][v][0], x["ranges"][v][1], x["counts"][v], x["totals"][v])
+                                 for v in x["avgs"])
+    columns = ["region", "country", "date", "variant", "freqMi", "freqLo", "freqUp", "count", "total"]
+    converted = pl.DataFrame(converted, schema=columns, orient="row").sort(columns[:4])
+    expected = golden.select(columns).sort(columns[:4])
+    if not converted.equals(expected):
+        raise CheckFailed(f"{path}: web conversion differs from the table")
+    result["web_geography"] = 0.0
+    return result
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs='*', default=[10_000, 100_000, 1_000_000], type=int,
+                        help="numbers of synthetic sequences to benchmark")
+    parser.add_argument("--countries", default=50, type=int, help="number of countries")
+    parser.add_argument("--clades", default=40, type=int, help="number of clades")
+    parser.add_argument("--days", default=730, type=int, help="number of days covered by the sequences")
+    parser.add_argument("--seed", default=0, type=int, help="seed of the synthetic data")
+    parser.add_argument("--reference", action="store_true",
+                        help="compare the batched single category fits to sparse fits of one system at a time "
+                        "and the hierarchical fits to sparse solves")
+    parser.add_argument("--golden", nargs='*', default=[], type=str,
+                        help="fit result tables to check against, e.g. data_web/inputs/*.csv")
+    parser.add_argument("--output", type=str, help="tsv file for the benchmark results")
+    parser.add_argument("--profile-json", type=str,
+                        help="json file with the profile of each size, including the timers and counters of the fits")
+
+    args = parser.parse_args()
+
+    for path in args.golden:
+        deviations = check_golden(path)
+        print(f"{path}: ok, " + ", ".join(f"{k} {v:.2g}" for k, v in deviations.items()))
+
+    summaries = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for n_sequences in args.sizes:
+            summaries.append(benchmark_size(n_sequences, work_dir, n_countries=args.countries, n_clades=args.clades,
+                                            n_days=args.days, seed=args.seed, reference=args.reference))
+    if args.profile_json:
+        with open(args.profile_json, "w") as fh:
+            json.dump(summaries, fh, indent=2)
+
+    records = [{"sequences": x["sequences"], **stage} for x in summaries for stage in x["stages"]]
+
+    if records:
+        df = pl.DataFrame(records)
+        with pl.Config(tbl_rows=len(df), tbl_cols=len(df.columns)):
+            print(df)
+        if args.output:
+            df.write_csv(args.output, separator='\t', float_precision=4)
@@ -0,0 +1,122 @@
+"""
+Script to produce all frequency tables of one lineage/segment in one process
+- the metadata is read once and counted once into an in-memory count cube
+  by all geographic categories, the frequency category and the mutations
+- region-frequencies.csv: single category fits by region
+- mutation_{mutation}-frequencies.csv: single category fits of each mutation
+  by region, fitted together with the region fits
+- continent-country-frequencies.csv: hierarchical fits by continent and country
+- weighted-region-frequencies.csv: population weighted regional and global
+  frequencies of the continent-country fits, computed from the fits in memory
+"""
+
+import os
+
+import polars as pl
+
+from . import profiling
+from .aggregate_counts import count_cube, count_rows
+from .fit_hierarchical_frequencies import fit_hierarchical_table
+from .fit_single_frequencies import (aggregate_tensor, fit_single_tables, load_fit_state, mutation_categories,
+                                     save_fit_state, scan_metadata, state_path)
+from .pop_weighted_aggregates import population_weighted_frequencies, read_population_table
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--metadata", type=str, help="filename with metadata, optionally compressed (.gz, .xz, .zst)")
+    parser.add_argument("--counts", type=str, help="count cube from aggregate_counts.py to use instead of --metadata")
+    parser.add_argument("--frequency-category", type=str, help="field to use for frequency categories")
+    parser.add_argument("--mutations", nargs='*', default=[], type=str,
+                        help="mutations or comma separated mutation combinations with their own frequency table")
+    parser.add_argument("--region-geo-categories", nargs='+', default=["region"], type=str,
+                        help="fields to use for geographic categories of the region and mutation frequencies")
+    parser.add_argument("--country-geo-categories", nargs='+', default=["continent", "iso3"], type=str,
+                        help="fields to use for geographic categories of the hierarchical fits, from the top level down")
+    parser.add_argument("--days", default=7, type=int, help="number of days in one time bin")
+    parser.add_argument("--min-date", type=str, help="date to start frequency calculation")
+    parser.add_argument("--inclusive-clades", type=str, help="whether or not to generate inclusive clade/lineage categories")
+    parser.add_argument("--workers", default=1, type=int, help="number of worker processes used for fitting")
+    parser.add_argument("--country-to-population", default="defaults/iso3_to_pop.tsv", type=str,
+                        help="tsv file with the population of each country (iso3, population)")
+    parser.add_argument("--country-to-region", default="profiles/flu/iso3_to_region.tsv", type=str,
+                        help="tsv file with the region of each country (iso3, continent)")
+    parser.add_argument("--population-cache", type=str, help="arrow file with the population of each country and "
+                        "region written by pop_weighted_aggregates, only read and ignored if older than the "
+                        "population and region tables")
+    parser.add_argument("--output-dir", type=str, help="directory for the frequency tables")
+    parser.add_argument("--state-dir", type=str, help="directory with the fits of the previous run, only systems "
+                        "with changed counts are fitted again and the state is updated")
+    parser.add_argument("--force", action="store_true", help="fit all systems, ignoring the state of the previous run")
+    parser.add_argument("--profile-json", type=str, help="file for the time, memory and counters of each stage")
+
+    args = parser.parse_args()
+    if args.profile_json:
+        profiling.enable()
+    stiffness = 5000/args.days
+    freq_cat = args.frequency_category
+    geo_categories = list(dict.fromkeys(args.region_geo_categories + args.country_geo_categories))
+
+    # all stages aggregate from one count cube instead of the rows of the metadata
+    with profiling.stage("read"):
+        if args.counts:
+            cube = pl.read_ipc(args.counts, memory_map=False)
+        else:
+            columns = geo_categories + [freq_cat, "date"] + (["aaSubstitutions"] if args.mutations else [])
+            d = scan_metadata(args.metadata, columns, min_date=args.min_date).collect()
+            profiling.count("rows_read", len(d))
+            if args.mutations:
+                d = mutation_categories(d, args.mutations)
+    if not args.counts:
+        with profiling.stage("count"):
+            cube = count_cube(d, geo_categories, [freq_cat] + args.mutations, min_date=args.min_date)
+            del d
+    profiling.count("cells", len(cube))
+
+    with profiling.stage("aggregate"):
+        single_tensors = [aggregate_tensor(count_rows(cube, x, args.region_geo_categories), args.region_geo_categories,
+                                           x, bin_size=args.days, min_date=args.min_date,
+                                           inclusive_clades="" if x in args.mutations else args.inclusive_clades,
+                                           count_column="count")[1]
+                          for x in [freq_cat] + args.mutations]
+        _, country_tensor = aggregate_tensor(count_rows(cube, freq_cat, args.country_geo_categories),
+                                             args.country_geo_categories, freq_cat, bin_size=args.days,
+                                             min_date=args.min_date, inclusive_clades=args.inclusive_clades,
+                                             count_column="count")
+
+    # the state of the single fits is kept with the region table, the one of the hierarchical fits with theirs
+    single_state, country_state = None, None
+    if args.state_dir:
+        state_paths = [state_path(args.state_dir, os.path.join(args.output_dir, x))
+                       for x in ["region-frequencies.csv", "continent-country-frequencies.csv"]]
+        with profiling.stage("load_state"):
+            single_state, country_state = [{} if args.force else load_fit_state(x) for x in state_paths]
+
+    # the region and mutation fits share one call, tensors with the same time bins one batch
+    with profiling.stage("fit_single"):
+        tables = fit_single_tables(single_tensors, stiffness, workers=args.workers, state=single_state)
+    with profiling.stage("fit_hierarchical"):
+        country_fits = fit_hierarchical_table(country_tensor, stiffness=stiffness, stiffness_minor=stiffness, mu=5.0,
+                                              workers=args.workers, level_columns=args.country_geo_categories[2:],
+                                              state=country_state)
+    with profiling.stage("weighted_average"):
+        population = read_population_table(args.country_to_population, args.country_to_region,
+                                           cache=args.population_cache)
+        weighted = population_weighted_frequencies(country_fits, population)
+
+    if args.state_dir:
+        with profiling.stage("save_state"):
+            save_fit_state(state_paths[0], single_state)
+            save_fit_state(state_paths[1], country_state)
+
+    with profiling.stage("write"):
+        os.makedirs(args.output_dir, exist_ok=True)
+        tables = dict(zip(["region-frequencies.csv"] + [f"mutation_{x}-frequencies.csv" for x in args.mutations], tables))
+        tables["continent-country-frequencies.csv"] = country_fits
+        for name, df in tables.items():
+            df.write_csv(os.path.join(args.output_dir, name), float_precision=4)
+            profiling.count("rows_written", len(df))
+        weighted.write_csv(os.path.join(args.output_dir, "weighted-region-frequencies.csv"), float_precision=5)
+        profiling.count("rows_written", len(weighted))
+    profiling.write(args.profile_json)
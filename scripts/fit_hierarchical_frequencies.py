@@ -2,24 +2,499 @@
 Script to estimate binomial probabilities
 - for each time bin
 - independently for each class of interest variant/mutation (vs rest)
-- for 2-level hierarchy of geographic categories
+- for a hierarchy of geographic categories of any depth (e.g. region, country, division)
 - top levels are estimated independently from each other
 - lower levels share information with top level
 - information is shared across time bins using Gaussian penalty
 """
 
-import matplotlib.pyplot as plt
+import itertools
+
 import numpy as np
 import polars as pl
-from fit_single_frequencies import load_and_aggregate, zero_one_clamp
+
+from . import profiling
+from .fit_single_frequencies import (active_windows, aggregate_tensor, boundary_system, frequency_table, load_fit_state,
+                                    run_tasks, save_fit_state, scan_metadata, shared_data, solve_tridiagonal,
+                                    state_path, system_hashes, tridiagonal_system, zero_count_weights)
 
 
 def geo_label_map(x):
     if x=='China': return 'China(PRC)'
     return x
 
-def fit_hierarchical_frequencies(totals, counts, time_bins, stiffness=0.5, stiffness_minor=0.1,
-                                 mu=0.3, use_inverse_for_confidence=True):
+def tridiagonal_matrix(diag, off):
+    return np.diag(diag) + np.diag(off, 1) + np.diag(off, -1)
+
+def _block_chunks(n_blocks, n_tp):
+    # batches of blocks whose dense T x T matrices take about 32MB
+    return np.array_split(np.arange(n_blocks), max(1, n_blocks*n_tp*n_tp//2**22))
+
+def block_elimination(diag, off, coupling):
+    """
+    Sum of W_c inv(B_c) W_c over tridiagonal blocks B_c, given by `diag` and
+    `off` along the last axis of (C, T) arrays, and diagonal couplings W_c of
+    shape (C, T). This is what eliminating the blocks subtracts from the block
+    they are coupled to. Returns a dense T x T matrix.
+    """
+    n_blocks, n_tp = np.shape(coupling)
+    identity = np.eye(n_tp)
+    out = np.zeros((n_tp, n_tp))
+    # inv(B_c) as T x T matrices, in chunks of blocks to bound memory
+    for chunk in _block_chunks(n_blocks, n_tp):
+        inverse = solve_tridiagonal(diag[chunk,None], off[chunk,None], identity, variance=False)
+        out += np.einsum('ci,cij,cj->ij', coupling[chunk], inverse, coupling[chunk])
+    return out
+
+def geo_tree(units, unit_totals, min_total=20):
+    """
+    Build the tree of geographic categories below one top level category from
+    its sorted `units` and their numbers of sequences. At every level, the
+    children with `min_total` or fewer sequences are pooled into "other",
+    which is fitted without data. Categories below the top level whose
+    children are all pooled are fitted as leaves with their own data.
+    Returns the nodes in post-order (children before parents, root last) as
+    dicts with the labels of the node, the index of its parent, whether it is
+    a leaf, the units it counts and the units it is fitted with.
+    """
+    depth = len(units[0])
+    nodes = []
+
+    def build(labels, rows):
+        level = len(labels)
+        children = []
+        if level < depth:
+            # the rows are sorted, so every child is a run of equal labels
+            labels_below = np.array([units[r][level] for r in rows], dtype=object)
+            starts = np.flatnonzero(np.r_[True, labels_below[1:]!=labels_below[:-1]])
+            groups = np.split(rows, starts[1:])
+            keep = np.add.reduceat(unit_totals[rows], starts) > min_total
+            if level==1 or any(keep):
+                pooled = [g for g, kept in zip(groups, keep) if not kept]
+                children.append(len(nodes))
+                nodes.append({"labels": labels + ("other",), "leaf": True,
+                              "units": np.concatenate(pooled) if pooled else np.zeros(0, dtype=int),
+                              "fit_units": np.zeros(0, dtype=int)})
+                for g in [g for g, kept in zip(groups, keep) if kept]:
+                    children.append(build(labels + (units[g[0]][level],), g))
+        node = {"labels": labels, "leaf": not children, "units": rows, "parent": -1,
+                "fit_units": np.concatenate([nodes[c]["fit_units"] for c in children]) if children else rows}
+        nodes.append(node)
+        for c in children:
+            nodes[c]["parent"] = len(nodes) - 1
+        return len(nodes) - 1
+
+    build((units[0][0],), np.arange(len(units)))
+    return nodes
+
+def node_sums(nodes, values, key="units"):
+    """
+    Sum `values` of shape (..., U, T) over the units of each node. `key` is
+    "units" for the data counted in the node or "fit_units" for the data it
+    is fitted with. Returns an array of shape (..., n_nodes, T).
+    """
+    return np.stack([values[...,node[key],:].sum(axis=-2) for node in nodes], axis=-2)
+
+def geo_tree_system(nodes, totals, counts, stiffness, stiffness_minor, mu, pc=3, extra_major=0.2):
+    """
+    Assemble the hierarchical model on a tree from `geo_tree` with `totals`
+    and `counts` of shape (n_nodes, T). Returns the tridiagonal penalties of
+    the adjustments of all nodes as `diag` and `off`, and the weights and
+    right hand sides of the data each node is fitted to, all as arrays with
+    one row per node. Leaves are fitted with weight 1, inner nodes with
+    `extra_major`.
+    """
+    n = np.asarray(totals, dtype=float)
+    k = np.asarray(counts, dtype=float)
+    n_nodes, n_tp = n.shape
+    leaf = np.array([x["leaf"] for x in nodes])
+    pre_fac = n**2/(k + pc)/(n - k + pc)
+    weight = np.where(leaf, 1.0, extra_major)[:,None]
+    # smoothness penalty of each node, nodes below the root (last) are also pulled to zero by mu
+    node_stiffness = np.full(n_nodes, stiffness_minor, dtype=float)
+    node_stiffness[-1] = stiffness
+    diag, off, _ = tridiagonal_system(np.zeros((n_nodes, n_tp)), np.zeros((n_nodes, n_tp)), node_stiffness, pc=pc)
+    diag[:-1] += mu
+    return diag, off, weight*n*pre_fac, weight*k*pre_fac
+
+def geo_tree_paths(nodes):
+    """
+    Boolean (n_nodes, n_nodes) matrix whose row i marks the nodes on the path
+    from node i to the root: the frequency of node i is the sum of their
+    adjustments.
+    """
+    paths = np.eye(len(nodes), dtype=bool)
+    # parents come after their children, so walking backwards completes each parent first
+    for ni in range(len(nodes) - 2, -1, -1):
+        paths[ni] |= paths[nodes[ni]["parent"]]
+    return paths
+
+def geo_tree_matrix(nodes, diag, off, data_w, data_b):
+    """
+    Assemble the full n_nodes T square matrix of the hierarchical model from
+    the arrays of `geo_tree_system` as a scipy CSR matrix, with the
+    adjustments of each node in a block of T rows in the order of `nodes`.
+    With the sparse map F = paths x I from adjustments to frequencies, the
+    matrix is the block diagonal of the penalties plus F^T diag(w) F and the
+    right hand side F^T b. Returns the matrix, the right hand side and F.
+    """
+    from scipy.sparse import block_diag, csr_matrix, diags, identity, kron
+    n_nodes, n_tp = data_w.shape
+    penalty = block_diag([diags([off[ni], diag[ni], off[ni]], [-1, 0, 1]) for ni in range(n_nodes)])
+    to_freq = kron(csr_matrix(geo_tree_paths(nodes).astype(float)), identity(n_tp), format="csr")
+    A = (penalty + to_freq.T @ diags(data_w.ravel()) @ to_freq).tocsr()
+    return A, to_freq.T @ data_b.ravel(), to_freq
+
+def sparse_geo_tree_solution(nodes, totals, counts, stiffness, stiffness_minor, mu, pc=3, extra_major=0.2,
+                             variance=True):
+    """
+    Solve the hierarchical model with spsolve on the matrix assembled by
+    `geo_tree_matrix`. Kept as a reference for `solve_geo_tree`, whose
+    return values it reproduces: the frequencies of shape (n_nodes, T) and,
+    if `variance` is set, the variances from dense inversion of the diagonal
+    blocks (True) or of the full matrix ("exact").
+    """
+    from scipy.sparse.linalg import spsolve
+    n_nodes, n_tp = np.shape(totals)
+    with profiling.timer("assemble"):
+        diag, off, data_w, data_b = geo_tree_system(nodes, totals, counts, stiffness, stiffness_minor, mu, pc=pc,
+                                                    extra_major=extra_major)
+        A, b, to_freq = geo_tree_matrix(nodes, diag, off, data_w, data_b)
+    if not data_w.any():
+        freq = np.full((n_nodes, n_tp), np.nan)
+        return (freq, freq.copy()) if variance else freq
+    profiling.count("systems_solved")
+    profiling.count("matrix_rows", A.shape[0])
+    profiling.count("matrix_nonzeros", A.nnz)
+    with profiling.timer("solve"):
+        freq = np.reshape(to_freq @ spsolve(A.tocsc(), b), (n_nodes, n_tp))
+    if not variance:
+        return freq
+
+    with profiling.timer("confidence"):
+        if variance=="exact":
+            cov = to_freq @ np.linalg.inv(A.toarray()) @ to_freq.T.toarray()
+            return freq, np.reshape(np.diag(cov), (n_nodes, n_tp))
+        block_variance = np.array([np.diag(np.linalg.inv(A[ni*n_tp:(ni+1)*n_tp, ni*n_tp:(ni+1)*n_tp].toarray()))
+                                   for ni in range(n_nodes)])
+        return freq, geo_tree_paths(nodes).astype(float) @ block_variance
+
+def solve_geo_tree(nodes, totals, counts, stiffness, stiffness_minor, mu, pc=3, extra_major=0.2, variance=True,
+                   tails=None, covariance=False):
+    """
+    Fit the hierarchical model on a tree of geographic categories from
+    `geo_tree`, with any number of levels.
+    Every node carries a frequency adjustment; the frequency of a node is the
+    sum of the adjustments along its path from the root. Leaves are fitted to
+    their data, inner nodes to the pooled data of their leaves with weight
+    `extra_major`. `totals` and `counts` have shape (n_nodes, T).
+
+    The tree is eliminated bottom up: given the frequency s of its parent,
+    the subtree of a node contributes a quadratic form s Q s/2 - g s, with
+    Q = Qt - Qt inv(P + Qt) Qt and g = gt - Qt inv(P + Qt) gt, where P is the
+    penalty of the node and Qt, gt collect its own data and the contributions
+    of its children. Leaf children are tridiagonal and handled in batches,
+    so the cost is O(leaves T^2 + inner nodes T^3).
+
+    Returns the frequencies of all nodes of shape (n_nodes, T) and, if
+    `variance` is set, their variances. Trees without any data are not
+    determined and all of their values are NaN. True sums the variances of the
+    diagonal blocks along the path, "exact" propagates the covariance of
+    the parent frequency s' = s + p as (I - K Qt) cov(s) (I - K Qt)^T + K
+    with K = inv(P + Qt).
+
+    With `covariance` (exact only) the covariances between the frequencies
+    of all pairs of nodes within the same time bin are returned as a third
+    array of shape (n_nodes, n_nodes, T), with the variances on its diagonal.
+    The frequency of a node is the gain of its path applied to independent
+    noise of every inner node above it, f = sum_c Y_c z_c, so two nodes
+    covary through the inner nodes they share.
+
+    `tails` are the totals of all nodes, of shape (n_nodes, L), in the time
+    bins without counts that were trimmed before and after the bins of
+    `totals`. Every node is eliminated there along its own chain (see
+    `tail_chains`) onto the boundary of the window, and the solution is
+    extended to them with `extend_geo_tree` (not with exact variances). This
+    is exact for bins without sequences; for bins with sequences it neglects
+    the coupling of the nodes at the boundary, so it is approximate.
+    """
+    if tails is None:
+        tails = (np.zeros((len(nodes), 0)), np.zeros((len(nodes), 0)))
+    trimmed = sum(np.shape(x)[-1] for x in tails)
+    if trimmed and variance=="exact":
+        raise ValueError("trimmed bins are not supported with exact variances")
+    if covariance and variance!="exact":
+        raise ValueError("covariances require variance='exact'")
+    n = np.asarray(totals, dtype=float)
+    k = np.asarray(counts, dtype=float)
+    n_nodes, n_tp = n.shape
+    root = n_nodes - 1
+    leaf = np.array([x["leaf"] for x in nodes])
+    parent = np.array([x["parent"] for x in nodes])
+    children = [[] for _ in nodes]
+    for ni in range(root):
+        children[parent[ni]].append(ni)
+
+    with profiling.timer("assemble"):
+        diag, off, data_w, data_b = geo_tree_system(nodes, n, k, stiffness, stiffness_minor, mu, pc=pc,
+                                                    extra_major=extra_major)
+        # given the boundary bin, the trimmed bins pull every node to zero with their sequences
+        for edge, (_, _, _, gain, _) in zip([0, -1], tail_chains(nodes, tails, stiffness, stiffness_minor, mu, pc=pc,
+                                                                  extra_major=extra_major)):
+            if gain.shape[-1]:
+                diag[:, edge] += node_stiffness(n_nodes, stiffness, stiffness_minor)*(1 - gain[:, 0])
+    if not data_w.any():
+        # without any data (e.g. all categories pooled into "other") the root penalty is singular
+        freq = np.full((n_nodes, n_tp + trimmed), np.nan)
+        if covariance:
+            return freq, freq.copy(), np.full((n_nodes, n_nodes, n_tp), np.nan)
+        return (freq, freq.copy()) if variance else freq
+    # tridiagonal blocks of all nodes and their coupling to the parent
+    profiling.count("systems_solved")
+    profiling.count("matrix_rows", n_nodes*n_tp)
+    profiling.count("matrix_nonzeros", n_nodes*(3*n_tp - 2) + 2*root*n_tp)
+
+    with profiling.timer("solve"):
+        # bottom up: collect the data of each inner node and the contributions of its children
+        quad, lin, inverse, message = {}, {}, {}, {}
+        for ni in np.flatnonzero(~leaf):
+            leaves = [c for c in children[ni] if leaf[c]]
+            q = np.diag(data_w[ni] + data_w[leaves].sum(axis=0)) - block_elimination(diag[leaves] + data_w[leaves], off[leaves], data_w[leaves])
+            g = data_b[ni] + data_b[leaves].sum(axis=0) - (data_w[leaves]*solve_tridiagonal(diag[leaves] + data_w[leaves], off[leaves],
+                                                                                              data_b[leaves], variance=False)).sum(axis=0)
+            for c in children[ni]:
+                if not leaf[c]:
+                    q += message[c][0]
+                    g += message[c][1]
+            quad[ni], lin[ni] = q, g
+            inverse[ni] = np.linalg.inv(tridiagonal_matrix(diag[ni], off[ni]) + q)
+            if ni!=root:
+                message[ni] = (q - q @ inverse[ni] @ q, g - q @ inverse[ni] @ g)
+
+        # top down: adjustments given the frequency of the parent
+        # without any counts the right hand side vanishes and so does the solution
+        freq = np.zeros((n_nodes, n_tp))
+        for ni in np.flatnonzero(~leaf)[::-1] if data_b.any() else []:
+            s = freq[parent[ni]] if ni!=root else np.zeros(n_tp)
+            freq[ni] = s + inverse[ni] @ (lin[ni] - quad[ni] @ s)
+            leaves = [c for c in children[ni] if leaf[c]]
+            freq[leaves] = freq[ni] + solve_tridiagonal(diag[leaves] + data_w[leaves], off[leaves],
+                                                        data_b[leaves] - data_w[leaves]*freq[ni], variance=False)
+    if not variance:
+        return extend_geo_tree(nodes, freq, None, tails, stiffness, stiffness_minor, mu, pc=pc,
+                                   extra_major=extra_major)[0] if trimmed else freq
+
+    with profiling.timer("confidence"):
+        if variance!="exact":
+            # each block sees the data of its whole subtree
+            subtree_w = data_w.copy()
+            for ni in range(root):
+                subtree_w[parent[ni]] += subtree_w[ni]
+            var = solve_tridiagonal(diag + subtree_w, off, np.zeros_like(n))[1]
+            for ni in range(root-1, -1, -1):
+                var[ni] += var[parent[ni]]
+            if trimmed:
+                return extend_geo_tree(nodes, freq, var, tails, stiffness, stiffness_minor, mu, pc=pc,
+                                       extra_major=extra_major)
+            return freq, var
+
+        var = np.zeros((n_nodes, n_tp))
+        cov = {}
+        identity = np.eye(n_tp)
+        for ni in np.flatnonzero(~leaf)[::-1]:
+            if ni==root:
+                cov[ni] = inverse[ni]
+            else:
+                gain = identity - inverse[ni] @ quad[ni]
+                cov[ni] = gain @ cov[parent[ni]] @ gain.T + inverse[ni]
+            var[ni] = np.diag(cov[ni])
+            # leaves: (I - inv(B) W) cov(s) (I - inv(B) W)^T with cov(s) = R R^T, plus inv(B)
+            leaves = np.array([c for c in children[ni] if leaf[c]], dtype=int)
+            factor = np.linalg.cholesky(cov[ni])
+            for chunk in _block_chunks(len(leaves), n_tp):
+                c = leaves[chunk]
+                y = solve_tridiagonal((diag[c] + data_w[c])[:,None], off[c][:,None],
+                                      (data_w[c][:,:,None]*factor).transpose(0,2,1), variance=False)
+                var[c] = ((factor.T - y)**2).sum(axis=1)
+            var[leaves] += solve_tridiagonal(diag[leaves] + data_w[leaves], off[leaves], np.zeros((len(leaves), n_tp)))[1]
+        if not covariance:
+            return freq, var
+
+        # transposed factors Y_c^T of every node for each inner node c above it, top down
+        factors = {}
+        for ni in np.flatnonzero(~leaf)[::-1]:
+            own = np.linalg.cholesky(inverse[ni]).T
+            if ni==root:
+                factors[ni] = {ni: own}
+            else:
+                gain = identity - inverse[ni] @ quad[ni]
+                factors[ni] = {c: y @ gain.T for c, y in factors[parent[ni]].items()}
+                factors[ni][ni] = own
+            # the own noise of the leaves only enters their variances
+            leaves = np.array([c for c in children[ni] if leaf[c]], dtype=int)
+            for c in leaves:
+                factors[c] = {}
+            for a, y in factors[ni].items():
+                for chunk in _block_chunks(len(leaves), n_tp):
+                    c = leaves[chunk]
+                    gained = y - solve_tridiagonal((diag[c] + data_w[c])[:,None], off[c][:,None],
+                                                   data_w[c][:,None,:]*y, variance=False)
+                    for ci, x in zip(c, gained):
+                        factors[ci][a] = x
+        cov = np.zeros((n_nodes, n_nodes, n_tp))
+        for a in np.flatnonzero(~leaf):
+            below = [ni for ni in range(n_nodes) if a in factors[ni]]
+            y = np.stack([factors[ni][a] for ni in below])
+            cov[np.ix_(below, below)] += np.einsum('ajt,bjt->abt', y, y)
+        cov[np.arange(n_nodes), np.arange(n_nodes)] = var
+        return freq, var, cov
+
+def node_stiffness(n_nodes, stiffness, stiffness_minor):
+    # the root (last) is smoothed with stiffness, the adjustments below with stiffness_minor
+    out = np.full(n_nodes, stiffness_minor, dtype=float)
+    out[-1] = stiffness
+    return out
+
+def tail_chains(nodes, tails, stiffness, stiffness_minor, mu, pc=3, extra_major=0.2):
+    """
+    Chains of all nodes in the trimmed bins before and after a window, ordered
+    from the boundary outwards (see `boundary_system`): the root frequency
+    with `stiffness`, the adjustments below with `stiffness_minor` and `mu`.
+    Each node is pulled to zero by its own sequences, weighted as in
+    `geo_tree_system`, and by all sequences below it, which reach it through
+    the smooth adjustments of its children. Returns, for the lead and the trail, the
+    weights, the diagonal and off-diagonal of the chains and their gain and
+    variance given the boundary, each with one row per node.
+    """
+    leaf = np.array([x["leaf"] for x in nodes])
+    parent = np.array([x["parent"] for x in nodes])
+    node_mu = np.full((len(nodes), 1), mu, dtype=float)
+    node_mu[-1] = 0
+    chains = []
+    for tail in [np.asarray(tails[0], dtype=float)[:, ::-1], np.asarray(tails[1], dtype=float)]:
+        weights = np.where(leaf, 1.0, extra_major)[:,None]*zero_count_weights(tail, pc)
+        for ni in range(len(nodes) - 1):
+            weights[parent[ni]] += weights[ni]
+        diag, off, b = boundary_system(weights, node_stiffness(len(nodes), stiffness, stiffness_minor), node_mu)
+        gain, gain_var = solve_tridiagonal(diag, off, b) if tail.shape[-1] else (np.zeros(tail.shape), np.zeros(tail.shape))
+        chains.append((weights, diag, off, gain, gain_var))
+    return chains
+
+def extend_geo_tree(nodes, freq, var, tails, stiffness, stiffness_minor, mu, pc=3, extra_major=0.2):
+    """
+    Extend the frequencies and block variances of a tree solved on a window
+    of time bins to the `tails` before and after it, given as the totals of
+    all nodes there (see `solve_geo_tree`). Top down, given the boundary and
+    the tail of its parent, the adjustment of each node follows its
+    `tail_chains`: it decays with `mu` and pulls the frequency of the node to
+    zero with the node's sequences, which all lack the variant. The root
+    keeps its value in bins without sequences and all variances grow.
+    """
+    parent = np.array([x["parent"] for x in nodes])
+    depth = np.zeros(len(nodes), dtype=int)
+    for ni in range(len(nodes) - 2, -1, -1):
+        depth[ni] = depth[parent[ni]] + 1
+
+    def beyond(chain, edge):
+        weights, diag, off, gain, gain_var = chain
+        # the adjustment of each node and its block variance at the boundary decay along its chain
+        f = gain*(freq[:, edge] - np.where(parent>=0, freq[parent, edge], 0))[:, None]
+        v = None if var is None else gain_var + gain**2*(var[:, edge] - np.where(parent>=0, var[parent, edge], 0))[:, None]
+        for level in range(1, depth.max() + 1) if weights.shape[-1] else []:
+            index = np.flatnonzero(depth==level)
+            up = parent[index]
+            # the node follows its parent, less what its own sequences pull it to zero
+            f[index] += f[up] - solve_tridiagonal(diag[index], off[index], weights[index]*f[up], variance=False)
+            if v is not None:
+                passed = 1 - solve_tridiagonal(diag[index], off[index], weights[index], variance=False)
+                v[index] += passed**2*v[up]
+        return f, v
+
+    lead, trail = tail_chains(nodes, tails, stiffness, stiffness_minor, mu, pc=pc, extra_major=extra_major)
+    (lead_freq, lead_var), (trail_freq, trail_var) = beyond(lead, 0), beyond(trail, -1)
+    freq = np.concatenate([lead_freq[:,::-1], freq, trail_freq], axis=1)
+    if var is None:
+        return freq, None
+    return freq, np.concatenate([lead_var[:,::-1], var, trail_var], axis=1)
+
+def diagonal_variances(nodes, totals, counts, mu, pc=3):
+    """
+    Approximate variances of the frequencies of all nodes from their own data
+    only, ignoring the smoothing over time: the binomial variance of each
+    node's adjustment, regularized by `mu` below the root, summed along the
+    path from the root.
+    """
+    n = np.asarray(totals, dtype=float)
+    k = np.asarray(counts, dtype=float)
+    node_mu = np.full((len(nodes), 1), mu, dtype=float)
+    node_mu[-1] = 0
+    block_variance = 1.0/((n**3 + pc)/(k + pc)/(n - k + pc) + node_mu)
+    return geo_tree_paths(nodes).astype(float) @ block_variance
+
+def fit_geo_tree(nodes, totals, counts, stiffness, stiffness_minor, mu, pc=3, use_inverse_for_confidence=True,
+                 padding=None, solver="schur"):
+    """
+    Fit a tree from `geo_tree` and return arrays `val`, `lower` and `upper`
+    of shape (n_nodes, T). The band of the root is centered on the unclamped
+    solution and the bands of the other nodes on the clamped values.
+    `solver` is either "schur" (tree elimination, see `solve_geo_tree`) or
+    "sparse" (see `sparse_geo_tree_solution`, kept as a reference).
+    `use_inverse_for_confidence` is True (variances of the diagonal blocks),
+    "exact" (exact variances) or False (see `diagonal_variances`).
+    If `padding` is set, the "schur" solver only solves the bins with counts
+    of the variant plus `padding` bins on either side (see `active_windows`)
+    and extends the solution to the bins without (see `solve_geo_tree`).
+    Exact variances are computed on all bins.
+    """
+    n_tp = np.shape(totals)[-1]
+    variance = use_inverse_for_confidence
+    if solver=="sparse":
+        fit = sparse_geo_tree_solution(nodes, totals, counts, stiffness, stiffness_minor, mu, pc=pc, variance=variance)
+    elif solver=="schur":
+        start, stop = 0, n_tp
+        if padding is not None and variance!="exact":
+            start, stop = (int(x) for x in active_windows(np.sum(counts, axis=0), padding))
+        fit = solve_geo_tree(nodes, totals[:, start:stop], counts[:, start:stop], stiffness, stiffness_minor, mu,
+                             pc=pc, variance=variance, tails=(totals[:, :start], totals[:, stop:]))
+    else:
+        raise ValueError(f"unknown solver: {solver}")
+    freq, var = fit if variance else (fit, diagonal_variances(nodes, totals, counts, mu, pc=pc))
+    val = np.clip(freq, 0, 1)
+    center = val.copy()
+    center[-1] = freq[-1]
+    dev = np.sqrt(var)
+    return val, np.clip(center - dev, 0, 1), np.clip(center + dev, 0, 1)
+
+def fit_hierarchical_arrays(totals, counts, stiffness=0.5, stiffness_minor=0.1, mu=0.3, pc=3,
+                            use_inverse_for_confidence=True, solver="schur"):
+    """
+    Fit the two level hierarchical model to arrays `totals` and `counts` of
+    shape (C, T) with the data of the C minor categories, as a tree with one
+    major category whose minor categories are all fitted with their own data
+    (see `fit_geo_tree` for `solver` and `use_inverse_for_confidence`).
+    Returns arrays `val`, `lower` and `upper` of shape (1 + C, T), where the
+    first row holds the major frequencies and the following rows the minor
+    categories.
+    """
+    n = np.asarray(totals, dtype=float)
+    k = np.asarray(counts, dtype=float)
+    n_minor = len(n)
+    nodes = [{"labels": ("major", ci), "leaf": True, "parent": n_minor} for ci in range(n_minor)]
+    nodes.append({"labels": ("major",), "leaf": False, "parent": -1})
+    fit = fit_geo_tree(nodes, np.concatenate([n, n.sum(axis=0, keepdims=True)]),
+                       np.concatenate([k, k.sum(axis=0, keepdims=True)]), stiffness, stiffness_minor, mu, pc=pc,
+                       use_inverse_for_confidence=use_inverse_for_confidence, solver=solver)
+    # the root comes last in the tree
+    return tuple(np.concatenate([x[-1:], x[:-1]]) for x in fit)
+
+def fit_hierarchical_categories(totals, counts, time_bins, stiffness=0.5, stiffness_minor=0.1,
+                                mu=0.3, pc=3, use_inverse_for_confidence=True, solver="schur"):
+    """
+    Fit the hierarchical model to dicts {minor: {t: n}} and return the results
+    as arrays, see `fit_hierarchical_arrays`. Returns the list of minor
+    categories and arrays `val`, `lower` and `upper` of shape (1 + n_minor, T),
+    with the minor categories in the order of the returned list.
+    """
 
     # Create copy but with "other" counts set to zero
     # Just for purpose of fitting, as if there was no data for "other"
@@ -29,183 +504,183 @@ def fit_hierarchical_frequencies(totals, counts, time_bins, stiffness=0.5, stiff
     totals['other'] = {}
 
     minor_cats = list(totals.keys())
-    n_tp = len(time_bins)
-    pc=3
-    values, column, row = [], [], []
-    b = []
-    sq_confidence = []
-    # deal with major frequency parameters
-    for ti, t in enumerate(time_bins):
-        if ti==0:
-            diag = stiffness
-            values.append(-stiffness); row.append(ti); column.append(ti+1)
-        elif ti==n_tp-1:
-            diag = stiffness
-            values.append(-stiffness); row.append(ti); column.append(ti-1)
-        else:
-            diag = 2*stiffness
-            values.append(-stiffness); row.append(ti); column.append(ti+1)
-            values.append(-stiffness); row.append(ti); column.append(ti-1)
-
-        res = 0
-        b_res = 0
-        total_n = 0
-        total_k = 0
-        for ci, cat in enumerate(minor_cats):
-            k = counts.get(cat, {}).get(t, 0)
-            n = totals.get(cat, {}).get(t, 0)
-            pre_fac = n**2/(k + pc)/(n - k + pc)
-            values.append(n*pre_fac); row.append(ti); column.append(ti + (ci+1)*n_tp)
-            total_n += n
-            total_k += k
-            res += n*pre_fac
-            b_res += k*pre_fac
-
-        pre_fac = total_n**2/(total_k + pc)/(total_n - total_k + pc)
-        extra_major = 0.2
-        values.append(diag + res + extra_major*total_n*pre_fac); row.append(ti); column.append(ti)
-        sq_confidence.append((total_k + pc)*(total_n - total_k + pc)/(total_n**3+pc))
-        b.append(b_res + extra_major*total_k*pre_fac)
-
-
-    # deal with frequency adjustment parameters
-    for ci, cat in enumerate(minor_cats):
-        for ti, t in enumerate(time_bins):
-            row_index = ti + (ci+1)*n_tp
-            if ti==0:
-                diag = stiffness_minor
-                values.append(-stiffness_minor); row.append(row_index); column.append(row_index+1)
-            elif ti==n_tp-1:
-                diag = stiffness_minor
-                values.append(-stiffness_minor); row.append(row_index); column.append(row_index-1)
-            else:
-                diag = 2*stiffness_minor
-                values.append(-stiffness_minor); row.append(row_index); column.append(row_index+1)
-                values.append(-stiffness_minor); row.append(row_index); column.append(row_index-1)
-
-            k = counts.get(cat, {}).get(t, 0)
-            n = totals.get(cat, {}).get(t, 0)
-            pre_fac = n**2/(k + pc)/(n - k + pc)
-            diag += n*pre_fac
-            values.append(diag + mu); row.append(row_index); column.append(row_index)
-            values.append(n*pre_fac); row.append(row_index); column.append(ti)
-            sq_confidence.append(1.0/((n**3+pc)/(k+pc)/(n-k+pc) + mu))
-            b.append(k*pre_fac)
-
-    from scipy.sparse import csr_matrix
-    from scipy.sparse.linalg import spsolve
-    A = csr_matrix((values, (row, column)), shape=(len(b), len(b)))
-    sol = spsolve(A,b)
-
-    if use_inverse_for_confidence:
-        try:
-            window = len(time_bins)
-            matrix_conf_intervals = []
-            for wi in range(len(b)//window):
-                matrix_conf_intervals.extend(np.diag(np.linalg.inv(A[wi*window:(wi+1)*window,wi*window:(wi+1)*window].todense())))
-            conf_to_use = matrix_conf_intervals
-        except:
-            print("Confidence through matrix inversion didn't work, using diagonal approximation instead.")
-            conf_to_use = sq_confidence
-    else:
-        conf_to_use = sq_confidence
+    n = np.array([[totals[cat].get(t, 0) for t in time_bins] for cat in minor_cats], dtype=float)
+    k = np.array([[counts.get(cat, {}).get(t, 0) for t in time_bins] for cat in minor_cats], dtype=float)
+    val, lower, upper = fit_hierarchical_arrays(n, k, stiffness=stiffness, stiffness_minor=stiffness_minor, mu=mu, pc=pc,
+                                                use_inverse_for_confidence=use_inverse_for_confidence, solver=solver)
+    return minor_cats, val, lower, upper
+
+def fit_hierarchical_frequencies(totals, counts, time_bins, stiffness=0.5, stiffness_minor=0.1,
+                                 mu=0.3, pc=3, use_inverse_for_confidence=True, solver="schur"):
+    minor_cats, val, lower, upper = fit_hierarchical_categories(totals, counts, time_bins, stiffness=stiffness,
+                                        stiffness_minor=stiffness_minor, mu=mu, pc=pc,
+                                        use_inverse_for_confidence=use_inverse_for_confidence, solver=solver)
 
     freqs = {"time_points": time_bins}
-    freqs["major_frequencies"] = {t:{"val": zero_one_clamp(sol[ti]),
-                                     "upper":zero_one_clamp(sol[ti]+np.sqrt(conf_to_use[ti])),
-                                     "lower":zero_one_clamp(sol[ti]-np.sqrt(conf_to_use[ti]))}
-                                     for ti,t in enumerate(time_bins)}
-    for ci, cat in enumerate(minor_cats):
-        freqs[cat] = {}
-        for ti,t in enumerate(time_bins):
-            row_index = ti + (ci+1)*n_tp
-            val = zero_one_clamp(sol[ti] + sol[row_index])
-            dev = np.sqrt(conf_to_use[ti] + conf_to_use[row_index])
-            freqs[cat][t] = {"val": val, "upper": zero_one_clamp(val+dev), "lower": zero_one_clamp(val-dev)}
+    for ci, cat in enumerate(["major_frequencies"] + minor_cats):
+        freqs[cat] = {t:{"val": val[ci,ti], "upper": upper[ci,ti], "lower": lower[ci,ti]}
+                      for ti,t in enumerate(time_bins)}
 
     return freqs
 
+def fit_top_geo_category(units, total_array, count_array, fcats, stiffness, stiffness_minor, mu, pc=3,
+                         use_inverse_for_confidence=True, padding=None, cached=None):
+    """
+    Fit the variants `fcats` for the geographic units `units` of one top level
+    category, with totals of shape (U, T) and counts of shape (n_fcats, U, T).
+    Returns the labels of the fitted rows, one label per level followed by the
+    variant, and a list of (count, total, val, lower, upper) arrays, one entry
+    per variant with the nodes of the tree in post-order (see `geo_tree`).
+    Labels of nodes above the lowest level are repeated for the levels below.
+    If `padding` is set, the variants are only fitted on the bins with
+    sequences in this category plus `padding` bins on either side, see
+    `fit_geo_tree`.
+    `cached` maps variants to (val, lower, upper) of a previous fit that is
+    reused instead of fitting them again.
+    """
+    cached = cached or {}
+    depth = len(units[0])
+    nodes = geo_tree(units, total_array.sum(axis=-1))
+    geo_labels = [x["labels"][:1] + tuple(geo_label_map(y) for y in x["labels"][1:]) for x in nodes]
+    geo_labels = [x + (x[-1],)*(depth - len(x)) for x in geo_labels]
+    node_totals = node_sums(nodes, total_array)
+    fit_totals = node_sums(nodes, total_array, key="fit_units")
+
+    labels, results = [], []
+    # the totals are shared, so variants with the same counts (e.g. none at all) share one fit
+    fits = {}
+    for fcat, counts in zip(fcats, count_array):
+        fit_counts = node_sums(nodes, counts, key="fit_units")
+        key = fit_counts.tobytes()
+        if fcat in cached:
+            fits[key] = cached[fcat]
+        elif key not in fits:
+            fits[key] = fit_geo_tree(nodes, fit_totals, fit_counts, stiffness, stiffness_minor, mu, pc=pc,
+                                     use_inverse_for_confidence=use_inverse_for_confidence, padding=padding)
+        val, lower, upper = fits[key]
+        labels.extend([x + (fcat,) for x in geo_labels])
+        results.append((node_sums(nodes, counts), node_totals, val, lower, upper))
+
+    return labels, results
+
+def _fit_top_geo_category(geo_cat, variant_index, stiffness, stiffness_minor, mu, pc, use_inverse_for_confidence, padding,
+                          cached):
+    tensor = shared_data()["tensor"]
+    sl = tensor.geo_slices()[(geo_cat,)]
+    return fit_top_geo_category(tensor.geo[sl], tensor.totals[sl], tensor.counts[sl, variant_index].transpose(1, 0, 2),
+                                [tensor.variants[vi] for vi in variant_index], stiffness, stiffness_minor, mu, pc=pc,
+                                use_inverse_for_confidence=use_inverse_for_confidence, padding=padding, cached=cached)
+
+def fit_hierarchical_table(tensor, stiffness, stiffness_minor, mu, pc=3, workers=1,
+                           use_inverse_for_confidence=True, level_columns=None, padding=None, state=None):
+    """
+    Fit all variants in all top level geographic categories of the
+    `CountTensor` and return the output table. The geographic levels are the
+    "region" and "country" columns; deeper levels are added as columns named
+    by `level_columns`. The work is split into one task per top level
+    category and batch of variants, see `run_tasks`. `padding` trims the
+    time axis of each fit, see `fit_top_geo_category`. `state` is a dict of
+    fits of a previous run keyed by `system_hashes` of each top level category
+    and variant; only variants with changed inputs are fitted again and the
+    dict is updated in place to hold the fits of this run.
+    """
+    dates = tensor.dates
+    depth = len(tensor.geo[0]) if tensor.geo else 2
+    if depth<2:
+        raise ValueError("the hierarchical model needs at least two geographic levels")
+    if level_columns is None:
+        level_columns = [f"level{i+1}" for i in range(2, depth)]
+
+    # one task per top level geographic category and batch of variants
+    tasks, weights, task_hashes = [], [], []
+    for (geo_cat,), sl in tensor.geo_slices().items():
+        geo_total = tensor.totals[sl].sum()
+        if state is not None:
+            counts = tensor.counts[sl].transpose(1, 0, 2).reshape(len(tensor.variants), -1)
+            hashes = system_hashes(counts, tensor.totals[sl].ravel(), dates, tensor.geo[sl], stiffness, stiffness_minor,
+                                   mu, pc, use_inverse_for_confidence, padding)
+        for variant_index in np.array_split(np.arange(len(tensor.variants)), workers):
+            if len(variant_index):
+                cached = {}
+                if state is not None:
+                    task_hashes.append([hashes[vi] for vi in variant_index])
+                    cached = {tensor.variants[vi]: state[hashes[vi]] for vi in variant_index if hashes[vi] in state}
+                tasks.append((geo_cat, variant_index, stiffness, stiffness_minor, mu, pc, use_inverse_for_confidence, padding,
+                              cached))
+                weights.append(geo_total*(len(variant_index) - len(cached))*(sl.stop - sl.start))
+    if state is not None:
+        profiling.count("systems", sum(len(x) for x in task_hashes))
+        profiling.count("systems_cached", sum(len(x[-1]) for x in tasks))
+
+    labels, results = [], []
+    fits = run_tasks(_fit_top_geo_category, tasks, workers=workers, weights=weights, shared={"tensor": tensor})
+    for task_labels, task_results in fits:
+        labels.extend(task_labels)
+        results.extend(task_results)
+    if state is not None:
+        state.clear()
+        state.update(zip(itertools.chain(*task_hashes), [x[2:] for x in results]))
+
+    columns = [np.concatenate(x) for x in zip(*results)] if len(results) else [np.zeros((0, len(dates)))]*5
+    levels = {name: [x[li+2] for x in labels] for li, name in enumerate(level_columns)}
+    return frequency_table(dates, [x[0] for x in labels], [x[1] for x in labels], [x[-1] for x in labels], *columns,
+                           levels=levels)
+
 if __name__=='__main__':
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument("--metadata", type=str, help="filename with metadata")
+    parser.add_argument("--metadata", type=str, help="filename with metadata, optionally compressed (.gz, .xz, .zst)")
+    parser.add_argument("--counts", type=str, help="count cube from aggregate_counts.py to use instead of --metadata")
     parser.add_argument("--frequency-category", type=str, help="field to use for frequency categories")
-    parser.add_argument("--geo-categories", nargs='+', type=str, help="field to use for geographic categories")
+    parser.add_argument("--geo-categories", nargs='+', type=str, help="fields to use for geographic categories, from the top level down")
     parser.add_argument("--days", default=7, type=int, help="number of days in one time bin")
     parser.add_argument("--min-date", type=str, help="date to start frequency calculation")
     parser.add_argument("--output-csv", type=str, help="output csv file")
     parser.add_argument("--inclusive-clades", type=str, help="whether or not to generate inclusive clade/lineage categories")
+    parser.add_argument("--workers", default=1, type=int, help="number of worker processes used for fitting")
+    parser.add_argument("--exact-confidence", action="store_true",
+                        help="use exact variances of the coupled system for the confidence intervals")
+    parser.add_argument("--trim-padding", type=int, help="fit each variant only on the time bins with counts of it "
+                        "in the region and this many bins on either side; the other bins are eliminated approximately")
+    parser.add_argument("--state-dir", type=str, help="directory with the fits of the previous run, only variants "
+                        "with changed counts are fitted again and the state is updated")
+    parser.add_argument("--force", action="store_true", help="fit all variants, ignoring the state of the previous run")
+    parser.add_argument("--profile-json", type=str, help="file for the time, memory and counters of each stage")
 
     args = parser.parse_args()
+    if args.profile_json:
+        profiling.enable()
 
-    d = pl.read_csv(args.metadata, separator='\t', try_parse_dates=False, columns=args.geo_categories + [args.frequency_category, 'date'])
     freq_cat = args.frequency_category
+    with profiling.stage("read"):
+        if args.counts:
+            from .aggregate_counts import read_count_cube
+            d = read_count_cube(args.counts, freq_cat, args.geo_categories)
+            count_column = "count"
+        else:
+            d = scan_metadata(args.metadata, args.geo_categories + [args.frequency_category, 'date'], min_date=args.min_date).collect()
+            count_column = None
+        profiling.count("rows_read", len(d))
 
-    d = d.with_columns(pl.col("date").str.strptime(pl.Date, format="%Y-%m-%d", strict=False))
-
-    data, totals, counts, time_bins = load_and_aggregate(d, args.geo_categories, freq_cat,
-                                                         bin_size=args.days, min_date=args.min_date, inclusive_clades=args.inclusive_clades)
-
-    dates = [time_bins[k] for k in time_bins]
+    with profiling.stage("aggregate"):
+        data, tensor = aggregate_tensor(d, args.geo_categories, freq_cat,
+                                        bin_size=args.days, min_date=args.min_date, inclusive_clades=args.inclusive_clades,
+                                        count_column=count_column)
 
-    major_geo_cats = set([tuple(k[:-2]) for k in totals])
-    output_data = []
-    # major_geo_cats = set([('Europe',)])
     stiffness = 5000/args.days
-    for geo_cat in major_geo_cats:
-        geo_label = ','.join(geo_cat)
-        minor_geo_cats = set([k[-2] for k in totals if k[:-2]==geo_cat])
-        sub_totals = {"other": {}}
-        data_totals = {}
-        for minor_geo_cat  in minor_geo_cats:
-            tmp = {k[-1]:v for k,v in totals.items() if k[:-2]==geo_cat and k[-2]==minor_geo_cat}
-            data_totals[minor_geo_cat] = sum(tmp.values())
-            if data_totals[minor_geo_cat]>20:
-                sub_totals[minor_geo_cat] = tmp
-            else:
-                # Put all minor categories with less than 20 sequences into one special category
-                sub_totals["other"] = {k: tmp.get(k, 0) + sub_totals["other"].get(k, 0) for k in set(tmp) | set(sub_totals["other"])}
-
-        sub_counts = {}
-        frequencies = {}
-        for fcat in counts.keys():
-            sub_counts[fcat] = {"other": {}}
-            for minor_geo_cat in minor_geo_cats:
-                tmp = {k[-1]:v for k,v in counts[fcat].items() if k[:-2]==geo_cat and k[-2]==minor_geo_cat}
-                if minor_geo_cat in sub_totals:
-                    sub_counts[fcat][minor_geo_cat] = tmp
-                else:
-                    sub_counts[fcat]["other"] = {k: tmp.get(k, 0) + sub_counts[fcat].get("other",{}).get(k, 0) for k in set(tmp) | set(sub_counts[fcat].get("other",{}))}
-            frequencies[fcat] = fit_hierarchical_frequencies(sub_totals, sub_counts[fcat],
-                                    sorted(time_bins.keys()), stiffness=stiffness,
-                                    stiffness_minor=stiffness, mu=5.0)
-
-            region_counts = {}
-            region_totals = {}
-            ## append entries for individual countries.
-            for minor_geo_cat in sub_totals:
-                for k, date in time_bins.items():
-                    output_data.append({"date": date.strftime('%Y-%m-%d'), "region": geo_label, "country": geo_label_map(minor_geo_cat),
-                                        "variant":fcat, "count": sub_counts[fcat][minor_geo_cat].get(k,0),
-                                        "total": sub_totals[minor_geo_cat].get(k,0),
-                                        "freqMi":frequencies[fcat][minor_geo_cat][k]['val'],
-                                        "freqLo":frequencies[fcat][minor_geo_cat][k]['lower'],
-                                        "freqUp":frequencies[fcat][minor_geo_cat][k]['upper']})
-                    region_counts[k] = region_counts.get(k, 0) + sub_counts[fcat][minor_geo_cat].get(k,0)
-                    region_totals[k] = region_totals.get(k, 0) + sub_totals[minor_geo_cat].get(k,0)
-
-            ## append entries for region frequencies
-            for k, date in time_bins.items():
-                output_data.append({"date": date.strftime('%Y-%m-%d'), "region": geo_label,
-                                    "country": geo_label, "variant":fcat,
-                                    "count": region_counts[k], "total": region_totals[k],
-                                    "freqMi":frequencies[fcat]["major_frequencies"][k]['val'],
-                                    "freqLo":frequencies[fcat]["major_frequencies"][k]['lower'],
-                                    "freqUp":frequencies[fcat]["major_frequencies"][k]['upper']})
-
-
-    df = pl.DataFrame(output_data, schema={'date':str, 'region':str, 'country':str, 'variant':str,
-                                           'count':int, 'total':int, 'freqMi':float, 'freqLo':float, 'freqUp':float})
+    state = None
+    if args.state_dir:
+        with profiling.stage("load_state"):
+            state = {} if args.force else load_fit_state(state_path(args.state_dir, args.output_csv))
+    previous = set(state or ())
+    with profiling.stage("fit"):
+        df = fit_hierarchical_table(tensor, stiffness=stiffness, stiffness_minor=stiffness, mu=5.0,
+                                    workers=args.workers, use_inverse_for_confidence="exact" if args.exact_confidence else True,
+                                    level_columns=args.geo_categories[2:], padding=args.trim_padding, state=state)
+    if args.state_dir:
+        print(f"fitted {len(state.keys() - previous)} of {len(state)} systems")
+        with profiling.stage("save_state"):
+            save_fit_state(state_path(args.state_dir, args.output_csv), state)
 
     # region_totals = {(r[0], r[1]): r[2] for r in df.select(['date', 'region', 'count'])
     #                         .groupby(['date', 'region']).sum().iter_rows()}
@@ -223,4 +698,7 @@ if __name__=='__main__':
     #         .alias('count')
     # ])
 
-    df.write_csv(args.output_csv, float_precision=4)
+    with profiling.stage("write"):
+        df.write_csv(args.output_csv, float_precision=4)
+        profiling.count("rows_written", len(df))
+    profiling.write(args.profile_json)
@@ -6,12 +6,16 @@ Script to estimate binomial probabilities
 - information is shared across time bins using Gaussian penalty
 """
 
-from collections import defaultdict
+import contextlib
+import hashlib
+import os
 from datetime import datetime
 
 import numpy as np
 import polars as pl
 
+from . import profiling
+
 
 def zero_one_clamp(x):
     if np.isnan(x): return x
@@ -33,7 +37,225 @@ def to_day_count(x, start_date):
 def day_count_to_date(x, start_date):
     return datetime.fromordinal(start_date + x)
 
-def load_and_aggregate(data, geo_categories, freq_category, min_date="2021-01-01", bin_size=7, inclusive_clades=""):
+def clade_hierarchy(clades):
+    """
+    Index the nesting of clade names, where a clade contains all clades whose
+    name starts with its own. Returns the clades in sorted order and a dict
+    mapping each clade with descendants to the slice of that sorted list
+    covering itself and all its descendants. Clades sharing a prefix are
+    contiguous after sorting, so each slice is found by bisection.
+    """
+    from bisect import bisect_left
+    ordered = sorted(clades)
+    groups = {}
+    for ci, clade in enumerate(ordered):
+        end = bisect_left(ordered, clade + chr(0x10ffff), lo=ci)
+        if end - ci > 1:
+            groups[clade] = slice(ci, end)
+    return ordered, groups
+
+def rollup_clades(values, groups):
+    """
+    Sum the rows of `values` (clades along the first axis, in the order
+    returned by `clade_hierarchy`) over each slice in `groups` using a single
+    cumulative sum. Returns an array with one row per group.
+    """
+    cumulative = np.zeros((len(values)+1,) + values.shape[1:], dtype=values.dtype)
+    np.cumsum(values, axis=0, out=cumulative[1:])
+    starts = np.array([g.start for g in groups.values()], dtype=int)
+    stops = np.array([g.stop for g in groups.values()], dtype=int)
+    return cumulative[stops] - cumulative[starts]
+
+@contextlib.contextmanager
+def open_decompressed(path):
+    """
+    Binary stream of the decompressed content of a .xz, .gz or .zst file.
+    zstd input is piped through the zstd command, which is checked on close
+    so that truncated or corrupt input raises instead of ending the stream
+    early.
+    """
+    if path.endswith(".xz"):
+        import lzma
+        with lzma.open(path) as fh:
+            yield fh
+        return
+    if path.endswith(".gz"):
+        import gzip
+        with gzip.open(path) as fh:
+            yield fh
+        return
+    import subprocess
+    proc = subprocess.Popen(["zstd", "-dc", path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        yield proc.stdout
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        error = proc.stderr.read().decode(errors="replace").strip()
+        proc.stderr.close()
+        proc.wait()
+    if proc.returncode:
+        raise OSError(f"zstd failed on {path}: {error or f'exit status {proc.returncode}'}")
+
+def read_compressed_batches(path, columns, batch_bytes=2**26):
+    """
+    Parse `columns` of a compressed TSV in batches of whole lines of about
+    `batch_bytes` decompressed bytes, yielding one DataFrame per batch. All
+    columns are read as strings so that every batch has the same schema.
+    """
+    schema = {col: pl.Utf8 for col in columns}
+    with open_decompressed(path) as fh:
+        header = fh.readline()
+        rest = b""
+        while True:
+            chunk = fh.read(batch_bytes)
+            lines = rest + chunk
+            if chunk:
+                end = lines.rfind(b"\n") + 1
+                lines, rest = lines[:end], lines[end:]
+            if lines:
+                yield pl.read_csv(header + lines, separator='\t', try_parse_dates=False, columns=columns,
+                                  dtypes=schema).select(columns)
+            if not chunk:
+                return
+
+def scan_metadata(path, columns, min_date=None):
+    """
+    Lazily read `columns` of a metadata TSV. Only the requested columns are
+    parsed, dates are converted while scanning and rows before `min_date`
+    are dropped before anything is materialized. Input compressed with xz,
+    gzip or zstd is decompressed as a stream and filtered batch by batch, so
+    only the rows that are kept are held in memory.
+    """
+    columns = list(dict.fromkeys(columns))
+
+    def select_dates(lf):
+        lf = lf.with_columns(pl.col("date").cast(pl.Utf8).str.strptime(pl.Date, format="%Y-%m-%d", strict=False))
+        if min_date:
+            lf = lf.filter(pl.col("date")>=pl.lit(min_date).str.strptime(pl.Date, format="%Y-%m-%d"))
+        return lf
+
+    if path.endswith((".xz", ".gz", ".zst")):
+        batches = [select_dates(batch.lazy()).collect() for batch in read_compressed_batches(path, columns)]
+        return pl.concat(batches).lazy()
+    return select_dates(pl.scan_csv(path, separator='\t', try_parse_dates=False,
+                                    dtypes={col: pl.Utf8 for col in columns}).select(columns))
+
+def geo_sort_key(geo):
+    # missing labels (e.g. no division) sort first
+    return tuple("" if x is None else str(x) for x in geo)
+
+class CountTensor:
+    """
+    Sequence counts aggregated by geographic unit, variant and time bin.
+    `counts` is an integer array of shape (G, V, T) and `totals` of shape
+    (G, T). Totals are kept separately since variants may overlap (inclusive
+    clades). `geo` holds one tuple of labels per unit with one label per
+    geographic level, in sorted order, `variants` the variant labels and
+    `time_bins` maps the time bin index of each column to its start date.
+    """
+    def __init__(self, geo, variants, time_bins, counts, totals):
+        self.geo = list(geo)
+        self.variants = list(variants)
+        self.time_bins = dict(time_bins)
+        self.counts = np.asarray(counts)
+        self.totals = np.asarray(totals)
+
+    @property
+    def time_keys(self):
+        return list(self.time_bins.keys())
+
+    @property
+    def dates(self):
+        return list(self.time_bins.values())
+
+    @property
+    def nbytes(self):
+        return self.counts.nbytes + self.totals.nbytes
+
+    def __repr__(self):
+        return (f"CountTensor({len(self.geo)} geographic units, {len(self.variants)} variants, "
+                f"{len(self.time_bins)} time bins)")
+
+    @classmethod
+    def from_dicts(cls, totals, counts, time_bins):
+        """
+        Build the tensor from the dicts {(geo..., t): n} and
+        {fcat: {(geo..., t): n}} of `load_and_aggregate`.
+        """
+        geo = sorted(set(k[:-1] for k in totals), key=geo_sort_key)
+        geo_index = {x: i for i, x in enumerate(geo)}
+        time_keys = sorted(time_bins)
+        time_index = {t: i for i, t in enumerate(time_keys)}
+
+        def fill(out, values):
+            if values:
+                out[[geo_index[k[:-1]] for k in values], [time_index[k[-1]] for k in values]] = list(values.values())
+            return out
+
+        tensor_totals = fill(np.zeros((len(geo), len(time_keys)), dtype=np.int32), totals)
+        tensor_counts = np.zeros((len(geo), len(counts), len(time_keys)), dtype=np.int32)
+        for vi, fcat in enumerate(counts):
+            fill(tensor_counts[:, vi], counts[fcat])
+        return cls(geo, counts.keys(), {t: time_bins[t] for t in time_keys}, tensor_counts, tensor_totals)
+
+    def to_dicts(self):
+        """
+        Dicts {(geo..., t): n} and {fcat: {(geo..., t): n}} with the nonzero
+        cells, as returned by `load_and_aggregate`.
+        """
+        time_keys = self.time_keys
+        gi, ti = np.nonzero(self.totals)
+        totals = {self.geo[g] + (time_keys[t],): int(n) for g, t, n in zip(gi, ti, self.totals[gi, ti])}
+        counts = {}
+        for vi, fcat in enumerate(self.variants):
+            gi, ti = np.nonzero(self.counts[:, vi])
+            counts[fcat] = {self.geo[g] + (time_keys[t],): int(n) for g, t, n in zip(gi, ti, self.counts[gi, vi, ti])}
+        return totals, counts
+
+    def select(self, geo=None, variants=None):
+        """
+        Subset of the tensor. `geo` is a slice, index array or boolean mask of
+        the geographic units and `variants` a list of variant labels.
+        """
+        geo_index = np.arange(len(self.geo))[geo if geo is not None else slice(None)]
+        variant_index = [self.variants.index(v) for v in variants] if variants is not None else slice(None)
+        return CountTensor([self.geo[g] for g in geo_index],
+                           np.array(self.variants, dtype=object)[variant_index],
+                           self.time_bins, self.counts[geo_index][:, variant_index], self.totals[geo_index])
+
+    def geo_slices(self, level=1):
+        """
+        Dict mapping the first `level` labels of the geographic units to the
+        slice of units that share them. Units are sorted, so they are contiguous.
+        """
+        slices = {}
+        for gi, unit in enumerate(self.geo):
+            prefix = unit[:level]
+            slices[prefix] = slice(slices[prefix].start if prefix in slices else gi, gi + 1)
+        return slices
+
+    def sum_geo(self, level):
+        """
+        Aggregate the geographic units to their first `level` labels.
+        """
+        slices = self.geo_slices(level)
+        starts = np.array([sl.start for sl in slices.values()], dtype=int)
+        return CountTensor(slices.keys(), self.variants, self.time_bins,
+                           np.add.reduceat(self.counts, starts, axis=0) if len(starts) else self.counts[:0],
+                           np.add.reduceat(self.totals, starts, axis=0) if len(starts) else self.totals[:0])
+
+def aggregate_tensor(data, geo_categories, freq_category, min_date="2021-01-01", bin_size=7, inclusive_clades="",
+                     count_column=None):
+    """
+    Aggregate sequence counts by geographic categories, time bin and
+    frequency category. Each row of `data` counts as one sequence unless
+    `count_column` names a column with pre-aggregated counts (as in a count
+    cube written by aggregate_counts.py). Only time bins with sequences are
+    included. Returns the filtered data and a `CountTensor`.
+    """
     if type(data)==str:
         d = pl.read_csv(data, separator='\t', try_parse_dates=True, columns = geo_categories + [freq_category, 'date'])
     else:
@@ -41,150 +263,617 @@ def load_and_aggregate(data, geo_categories, freq_category, min_date="2021-01-01
 
     start_date = datetime.strptime(min_date, "%Y-%m-%d").toordinal()
     d = d.filter((~pl.col('date').is_null())&(~pl.col(freq_category).is_null()))
-    d = d.with_columns([pl.col('date').map_elements(lambda x: to_day_count(x, start_date)).alias("day_count")])
+    d = d.with_columns([(pl.col('date').cast(pl.Date) - pl.lit(datetime.fromordinal(start_date).date()))
+                            .dt.total_days().alias("day_count")])
     d = d.filter(pl.col("day_count")>=0)
     d = d.with_columns([(pl.col('day_count')//bin_size).alias("time_bin")])
 
-    totals = dict()
-    for row in d.group_by(by=geo_categories + ["time_bin"]).count().iter_rows():
-        totals[row[:-1]] = row[-1]
-
-    fcats = d[freq_category].unique()
-    counts = {}
-    for fcat in fcats:
-        tmp = {}
-        for row in d.filter(pl.col(freq_category)==fcat).group_by(by=geo_categories + ["time_bin"]).count().iter_rows():
-            tmp[row[:-1]] = row[-1]
-        counts[fcat] = tmp
-
-    # For each cat in fcats, add a new category that also includes all children clades
-    children = defaultdict(list)
-    for fcat in fcats:
-        for fcat2 in fcats:
-            if fcat2.startswith(fcat):
-                children[fcat].append(fcat2)
+    # one group_by for all categories, totals are derived from it
+    if count_column:
+        grouped = d.group_by(geo_categories + ["time_bin", freq_category]).agg(pl.col(count_column).cast(pl.Int64).sum().alias("count"))
+    else:
+        grouped = d.group_by(geo_categories + ["time_bin", freq_category]).count()
+
+    geo_keys = list(grouped.select(geo_categories).iter_rows())
+    geo = sorted(set(geo_keys), key=geo_sort_key)
+    geo_index = {x: i for i, x in enumerate(geo)}
+    variants = sorted(set(grouped[freq_category]))
+    variant_index = {x: i for i, x in enumerate(variants)}
+    bins = grouped["time_bin"].to_numpy()
+    time_keys = np.unique(bins)
+
+    counts = np.zeros((len(geo), len(variants), len(time_keys)), dtype=np.int32)
+    counts[[geo_index[x] for x in geo_keys], [variant_index[x] for x in grouped[freq_category]],
+           np.searchsorted(time_keys, bins)] = grouped["count"].to_numpy()
+    totals = counts.sum(axis=1, dtype=np.int32)
 
     if inclusive_clades == "flu":
-        for lineage, children in children.items():
-            if len(children)<=1: continue
-            tmp = {}
-            for child in children:
-                # tmp is a dict where values are integers
-                # I want to add dicts so that values are summed
-                tmp = {k: tmp.get(k, 0) + counts[child].get(k, 0) for k in set(tmp) | set(counts[child])}
-            counts[lineage + "*"] = tmp
-
-    timebins = {int(x): day_count_to_date(x*bin_size, start_date) for x in sorted(d["time_bin"].unique())}
-
-    return d, totals, counts, timebins
-
-def fit_single_category(totals, counts, time_bins, stiffness=0.3, pc=3, nstd = 2):
-
-    values, column, row = [], [], []
-    b = []
-    for ti, t in enumerate(time_bins):
-        if t==time_bins[0]:
-            diag = stiffness
-            values.append(-stiffness)
-            row.append(ti)
-            column.append(ti+1)
-        elif t==time_bins[-1]:
-            diag = stiffness
-            values.append(-stiffness)
-            row.append(ti)
-            column.append(ti-1)
-        else:
-            diag = 2*stiffness
-            values.append(-stiffness)
-            row.append(ti)
-            column.append(ti+1)
-            values.append(-stiffness)
-            row.append(ti)
-            column.append(ti-1)
-
-        k = counts.get(t, 0)
-        n = totals.get(t, 0)
-        try:
-            pre_fac = n**2/(k + pc)/(n - k + pc)
-        except:
-            print(n,k,pc)
-            pre_fac = n**2/(k + pc)/(n - k + pc)
-
-        diag += n*pre_fac
-        values.append(diag)
-        row.append(ti)
-        column.append(ti)
-        b.append(k*pre_fac)
-
-    from numpy.linalg import inv
-    from scipy.sparse import csr_matrix
-    from scipy.sparse.linalg import spsolve
-    A = csr_matrix((values, (row, column)), shape=(len(b), len(b)))
-    sol = spsolve(A,b)
-    confidence = np.sqrt(np.diag(inv(A.todense())))
+        _, groups = clade_hierarchy(variants)
+        if len(groups):
+            inclusive = rollup_clades(counts.transpose(1, 0, 2), groups).transpose(1, 0, 2)
+            counts = np.concatenate([counts, inclusive], axis=1)
+            variants = variants + [clade + "*" for clade in groups]
+
+    timebins = {int(x): day_count_to_date(int(x)*bin_size, start_date) for x in time_keys}
+
+    return d, CountTensor(geo, variants, timebins, counts, totals)
+
+def load_and_aggregate(data, geo_categories, freq_category, min_date="2021-01-01", bin_size=7, inclusive_clades="",
+                       count_column=None):
+    """
+    Dict interface of `aggregate_tensor`. Returns the filtered data, totals
+    as {(geo..., t): n}, counts as {fcat: {(geo..., t): n}} and the time bins.
+    """
+    d, tensor = aggregate_tensor(data, geo_categories, freq_category, min_date=min_date, bin_size=bin_size,
+                                 inclusive_clades=inclusive_clades, count_column=count_column)
+    totals, counts = tensor.to_dicts()
+    return d, totals, counts, tensor.time_bins
+
+def tridiagonal_system(totals, counts, stiffness, pc=3):
+    """
+    Assemble the symmetric tridiagonal system of a single category.
+    `totals` and `counts` hold the time bins along the last axis.
+    `stiffness` and `pc` are scalars or hold one value per system.
+    Returns the diagonal, the off-diagonal and the right hand side.
+    """
+    n = np.asarray(totals, dtype=float)
+    k = np.asarray(counts, dtype=float)
+    stiffness = np.asarray(stiffness, dtype=float)[...,None]
+    pc = np.asarray(pc, dtype=float)[...,None]
+    n_tp = n.shape[-1]
+    pre_fac = n**2/(k + pc)/(n - k + pc)
+
+    # first and last time bin only have one neighbor
+    neighbors = np.full(n_tp, 2.0)
+    neighbors[0] = neighbors[-1] = 1.0
+    diag = stiffness*neighbors + n*pre_fac
+    off = np.broadcast_to(-stiffness, diag.shape[:-1] + (n_tp-1,)).copy()
+    return diag, off, k*pre_fac
+
+def solve_tridiagonal(diag, off, b, variance=True):
+    """
+    Solve a symmetric tridiagonal system in O(T) using an LDL^T factorization.
+    Time bins are along the last axis, leading axes are independent systems.
+    If `variance` is set, the diagonal of the inverse is returned as well. It
+    follows from the forward pivots D and backward pivots S of the matrix as
+    inv(A)[i,i] = 1/(D[i] + S[i] - A[i,i]) (selected inversion).
+    """
+    b = np.asarray(b, dtype=float)
+    shape = np.broadcast_shapes(np.shape(diag), b.shape)
+    diag = np.broadcast_to(np.asarray(diag, dtype=float), shape)
+    off = np.broadcast_to(np.asarray(off, dtype=float), shape[:-1] + (shape[-1]-1,))
+    b = np.broadcast_to(b, shape)
+    n_tp = shape[-1]
+
+    # forward elimination
+    fwd = np.empty(shape)
+    z = np.empty(shape)
+    fwd[...,0] = diag[...,0]
+    z[...,0] = b[...,0]
+    for ti in range(1, n_tp):
+        ratio = off[...,ti-1]/fwd[...,ti-1]
+        fwd[...,ti] = diag[...,ti] - ratio*off[...,ti-1]
+        z[...,ti] = b[...,ti] - ratio*z[...,ti-1]
+
+    # back substitution
+    sol = np.empty(shape)
+    sol[...,-1] = z[...,-1]/fwd[...,-1]
+    for ti in range(n_tp-2, -1, -1):
+        sol[...,ti] = (z[...,ti] - off[...,ti]*sol[...,ti+1])/fwd[...,ti]
+
+    if not variance:
+        return sol
+
+    bwd = np.empty(shape)
+    bwd[...,-1] = diag[...,-1]
+    for ti in range(n_tp-2, -1, -1):
+        bwd[...,ti] = diag[...,ti] - off[...,ti]**2/bwd[...,ti+1]
+
+    return sol, 1.0/(fwd + bwd - diag)
+
+def fit_single_category(totals, counts, time_bins, stiffness=0.3, pc=3, nstd = 2, solver="banded"):
+    """
+    Fit the frequency trajectory of one category. `solver` is either "banded"
+    (O(T) tridiagonal solve with exact variances) or "sparse" (generic sparse
+    solve and dense inversion, kept as a reference). The system matrix is
+    returned as a scipy sparse matrix for "sparse" and in the (3, T) banded
+    layout of scipy.linalg.solve_banded for "banded".
+    """
+    k = [counts.get(t, 0) for t in time_bins]
+    n = [totals.get(t, 0) for t in time_bins]
+    with profiling.timer("assemble"):
+        diag, off, b = tridiagonal_system(n, k, stiffness, pc=pc)
+    profiling.count("systems_solved")
+    profiling.count("matrix_rows", len(b))
+    profiling.count("matrix_nonzeros", 3*len(b) - 2)
+
+    if solver=="banded":
+        with profiling.timer("solve"):
+            sol, variance = solve_tridiagonal(diag, off, b)
+        A = np.zeros((3, len(b)))
+        A[0,1:] = off
+        A[1] = diag
+        A[2,:-1] = off
+    elif solver=="sparse":
+        from numpy.linalg import inv
+        from scipy.sparse import diags
+        from scipy.sparse.linalg import spsolve
+        A = diags([off, diag, off], [-1, 0, 1], format='csr')
+        with profiling.timer("solve"):
+            sol = spsolve(A,b)
+        with profiling.timer("confidence"):
+            variance = np.diag(inv(A.todense()))
+    else:
+        raise ValueError(f"unknown solver: {solver}")
+
+    confidence = np.sqrt(variance)
 
     return {t:{'val': sol[ti],
                'upper': min(1.0, sol[ti] + nstd*confidence[ti]),
                'lower': max(0.0, sol[ti] - nstd*confidence[ti])} for ti,t in enumerate(time_bins)}, A
 
+def active_windows(counts, padding):
+    """
+    Window of time bins with counts of each system, along the last axis of
+    `counts`, widened by `padding` bins on both sides and clipped to the time
+    axis. Windows span at least two bins, systems without counts all bins.
+    The bins outside only hold sequences without the variant, see
+    `window_tails`. Returns arrays with the first bin and the end of each
+    window.
+    """
+    active = np.asarray(counts) > 0
+    n_tp = active.shape[-1]
+    observed = active.any(axis=-1)
+    start = np.maximum(np.where(observed, active.argmax(axis=-1), 0) - padding, 0)
+    stop = np.minimum(np.where(observed, n_tp - active[...,::-1].argmax(axis=-1), n_tp) + padding, n_tp)
+    stop = np.minimum(np.maximum(stop, start + 2), n_tp)
+    start = np.maximum(np.minimum(start, stop - 2), 0)
+    return start, stop
+
+def fill_windows(values, start, n_tp):
+    """
+    Expand `values` of shape (n_systems, L), solved on windows starting at
+    `start`, to all `n_tp` time bins. Bins outside a window take the value at
+    its boundary.
+    """
+    fill = np.clip(np.arange(n_tp) - np.reshape(start, (-1, 1)), 0, values.shape[-1] - 1)
+    return np.take_along_axis(values, fill, axis=-1)
+
+def boundary_system(weights, stiffness, mu=0.0):
+    """
+    Time bins beyond the boundary of a trimmed system whose sequences all
+    lack the variant, with data precision `weights` along the last axis,
+    starting next to the boundary: a chain with smoothness `stiffness`,
+    pulled to zero by `mu` and by the data, attached to the boundary bin.
+    Leading axes are independent chains, `stiffness` is a scalar or holds
+    one value per chain. Returns the diagonal, the off-diagonal and the
+    right hand side for a unit value at the boundary.
+    """
+    weights = np.asarray(weights, dtype=float)
+    stiffness = np.asarray(stiffness, dtype=float)[...,None]
+    length = weights.shape[-1]
+    # the first bin is also tied to the boundary, the last one is the end of the time axis
+    neighbors = np.full(length, 2.0)
+    if length:
+        neighbors[-1] = 1.0
+    diag = stiffness*neighbors + weights + mu
+    off = np.broadcast_to(-stiffness, diag.shape[:-1] + (max(length - 1, 0),)).copy()
+    b = np.zeros(diag.shape)
+    b[...,:1] = stiffness
+    return diag, off, b
+
+def boundary_chain(weights, stiffness, mu=0.0):
+    """
+    Solution of `boundary_system`: given the value x_b at the boundary, the
+    bin at distance d has mean h[d-1] x_b and variance var[d-1]. Without
+    sequences and `mu`, h is 1 and the variance grows as d/stiffness.
+    Returns h and var.
+    """
+    diag, off, b = boundary_system(weights, stiffness, mu)
+    if not diag.shape[-1]:
+        return np.zeros(diag.shape), np.zeros(diag.shape)
+    return solve_tridiagonal(diag, off, b)
+
+def zero_count_weights(totals, pc=3):
+    """
+    Data precision of time bins with `totals` sequences and no counts, as on
+    the diagonal of `tridiagonal_system`. `pc` is a scalar or holds one value
+    per system.
+    """
+    n = np.asarray(totals, dtype=float)
+    pc = np.asarray(pc, dtype=float)[...,None]
+    return n*n**2/pc/(n + pc)
+
+def window_tails(totals, start, stop, stiffness, pc=3):
+    """
+    Eliminate the bins outside the windows [start, stop) of systems with
+    `totals` of shape (n_systems, T), where all counts are zero. Given its
+    boundary, each tail is a `boundary_chain` on its `zero_count_weights`.
+    Returns the gain h and the variance c of every bin, 1 and 0 inside the
+    windows, such that the solution is h x_b with variance c + h^2 var(x_b)
+    for the boundary value x_b of the nearest window bin. Also returns the precision that each tail
+    adds to the first and last bin of its window, of shape (n_systems, 2);
+    with it, the window alone is solved exactly.
+    """
+    n_systems, n_tp = totals.shape
+    stiffness = np.broadcast_to(np.asarray(stiffness, dtype=float), (n_systems,))
+    pc = np.broadcast_to(np.asarray(pc, dtype=float), (n_systems,))
+    gain, gain_var, edges = np.ones((n_systems, n_tp)), np.zeros((n_systems, n_tp)), np.zeros((n_systems, 2))
+    for lead in np.unique(start[start>0]):
+        index = np.flatnonzero(start==lead)
+        h, c = boundary_chain(zero_count_weights(totals[index, lead-1::-1], pc[index]), stiffness[index])
+        gain[index, :lead], gain_var[index, :lead] = h[:, ::-1], c[:, ::-1]
+        edges[index, 0] = stiffness[index]*(1 - h[:, 0])
+    for trail in np.unique(n_tp - stop[stop<n_tp]):
+        index = np.flatnonzero(n_tp - stop==trail)
+        h, c = boundary_chain(zero_count_weights(totals[index, n_tp-trail:], pc[index]), stiffness[index])
+        gain[index, n_tp-trail:], gain_var[index, n_tp-trail:] = h, c
+        edges[index, 1] = stiffness[index]*(1 - h[:, 0])
+    return gain, gain_var, edges
+
+def _solve_single(totals, counts, stiffness, pc, solver, edges=None):
+    with profiling.timer("assemble"):
+        diag, off, b = tridiagonal_system(totals, counts, stiffness, pc=pc)
+        if edges is not None:
+            diag[:, [0, -1]] += edges
+    n_systems, n_tp = b.shape
+    profiling.count("systems_solved", n_systems)
+    profiling.count("matrix_rows", n_systems*n_tp)
+    profiling.count("matrix_nonzeros", n_systems*(3*n_tp - 2))
+
+    if solver=="banded":
+        # the variances come out of the same sweeps
+        with profiling.timer("solve"):
+            val, variance = solve_tridiagonal(diag, off, b)
+    elif solver=="sparse":
+        from numpy.linalg import inv
+        from scipy.sparse import diags
+        from scipy.sparse.linalg import spsolve
+        val = np.empty_like(b)
+        variance = np.empty_like(b)
+        for si in range(len(b)):
+            A = diags([off[si], diag[si], off[si]], [-1, 0, 1], format='csr')
+            with profiling.timer("solve"):
+                val[si] = spsolve(A, b[si])
+            with profiling.timer("confidence"):
+                variance[si] = np.diag(inv(A.todense()))
+    else:
+        raise ValueError(f"unknown solver: {solver}")
+    return val, variance
+
+def fit_single_categories(totals, counts, stiffness=0.3, pc=3, nstd=2, solver="banded", padding=None):
+    """
+    Batched version of `fit_single_category`. `totals` and `counts` are
+    arrays of shape (n_systems, T) (totals may also be shared as shape (T,)),
+    `stiffness` and `pc` are scalars or arrays with one value per system.
+    All systems are solved at once with vectorized tridiagonal sweeps.
+    Returns arrays `val`, `lower` and `upper` of shape (n_systems, T).
+    Systems with identical counts and totals (and parameters) are solved once.
+    If `padding` is set, each system is only solved on the bins with
+    counts plus `padding` bins on either side (see `active_windows`),
+    systems with windows of equal length in one batch. The bins outside the
+    window only hold sequences without the variant; they are eliminated
+    exactly onto the window boundary and the solution is extended to them
+    (see `window_tails`), so trimming does not change the fit.
+    """
+    counts = np.atleast_2d(np.asarray(counts, dtype=float))
+    totals = np.broadcast_to(np.asarray(totals, dtype=float), counts.shape)
+    if np.ndim(stiffness)==0 and np.ndim(pc)==0 and len(counts)>1:
+        _, index, inverse = np.unique(np.concatenate([counts, totals], axis=-1), axis=0,
+                                      return_index=True, return_inverse=True)
+        if len(index)<len(counts):
+            fits = fit_single_categories(totals[index], counts[index], stiffness=stiffness, pc=pc, nstd=nstd,
+                                         solver=solver, padding=padding)
+            return tuple(x[inverse.reshape(-1)] for x in fits)
+
+    if padding is None:
+        val, variance = _solve_single(totals, counts, stiffness, pc, solver)
+    else:
+        n_systems, n_tp = counts.shape
+        stiffness = np.broadcast_to(np.asarray(stiffness, dtype=float), (n_systems,))
+        pc = np.broadcast_to(np.asarray(pc, dtype=float), (n_systems,))
+        start, stop = active_windows(counts, padding)
+        gain, gain_var, edges = window_tails(totals, start, stop, stiffness, pc=pc)
+        val, variance = np.empty(counts.shape), np.empty(counts.shape)
+        for length in np.unique(stop - start):
+            index = np.flatnonzero(stop - start==length)
+            columns = start[index,None] + np.arange(length)
+            window_val, window_variance = _solve_single(totals[index[:,None], columns], counts[index[:,None], columns],
+                                                        stiffness[index], pc[index], solver, edges=edges[index])
+            val[index] = fill_windows(window_val, start[index], n_tp)
+            variance[index] = fill_windows(window_variance, start[index], n_tp)
+        val, variance = gain*val, gain_var + gain**2*variance
+
+    confidence = nstd*np.sqrt(variance)
+    return val, np.maximum(0.0, val - confidence), np.minimum(1.0, val + confidence)
+
+
+def mutation_categories(d, mutation_sets, column="aaSubstitutions"):
+    """
+    Classify each row by the requested mutations it carries. `mutation_sets`
+    are comma separated mutations such as "HA1:P137S,HA1:K142R". The
+    substitutions are tokenized once and each set adds a column named after
+    it, holding the matching mutations of a row joined by "," or "WT".
+    Rows without substitutions stay null and are dropped in aggregation.
+    """
+    d = d.with_columns(pl.col(column).str.split(",").alias("_tokens"))
+    d = d.with_columns([
+        pl.col("_tokens").list.eval(pl.element().filter(pl.element().is_in(mutations.split(","))))
+          .list.join(",").alias(mutations)
+        for mutations in mutation_sets
+    ])
+    d = d.with_columns([
+        pl.when(pl.col(mutations)=="").then(pl.lit("WT")).otherwise(pl.col(mutations)).alias(mutations)
+        for mutations in mutation_sets
+    ])
+    return d.drop("_tokens")
+
+def single_category_systems(tensor, min_count=10):
+    """
+    Slice a `CountTensor` into one system per geographic category and
+    frequency category with more than `min_count` sequences.
+    Returns the (geo_label, fcat) pairs and count and total arrays of shape
+    (n_systems, T).
+    """
+    gi, vi = np.nonzero(tensor.counts.sum(axis=-1) > min_count)
+    systems = [(','.join(tensor.geo[g]), tensor.variants[v]) for g, v in zip(gi, vi)]
+    return systems, tensor.counts[gi, vi], tensor.totals[gi]
+
+def frequency_table(dates, regions, countries, variants, count, total, freqMi, freqLo, freqUp, levels=None):
+    """
+    Assemble the output table column by column. Every fitted system
+    contributes one row per time bin: `regions`, `countries` and `variants`
+    hold one label per system (`countries` may be None), while `count`,
+    `total` and the frequency arrays are of shape (n_systems, T).
+    `dates` are the time bin start dates. `levels` optionally maps the names
+    of additional geographic columns, placed after "country", to their labels.
+    """
+    n_systems, n_tp = np.shape(freqMi)
+    system_index = np.repeat(np.arange(n_systems), n_tp)
+    def labels(x):
+        return pl.Series(x, dtype=pl.Utf8).gather(system_index) if x is not None else pl.Series([None]*len(system_index), dtype=pl.Utf8)
+
+    return pl.DataFrame({
+        "date": pl.Series([d.strftime('%Y-%m-%d') for d in dates], dtype=pl.Utf8).gather(np.tile(np.arange(n_tp), n_systems)),
+        "region": labels(regions),
+        "country": labels(countries),
+        **{name: labels(x) for name, x in (levels or {}).items()},
+        "variant": labels(variants),
+        "count": np.asarray(count, dtype=np.int64).ravel(),
+        "total": np.asarray(total, dtype=np.int64).ravel(),
+        "freqMi": np.asarray(freqMi, dtype=float).ravel(),
+        "freqLo": np.asarray(freqLo, dtype=float).ravel(),
+        "freqUp": np.asarray(freqUp, dtype=float).ravel(),
+    })
+
+
+# inputs shared with worker processes, set once per worker by `run_tasks`
+_shared = {}
+
+def _share(shared):
+    _shared.update(shared)
+
+def shared_data():
+    return _shared
+
+def run_tasks(func, tasks, workers=1, weights=None, shared=None):
+    """
+    Evaluate `func(*task)` for every task and return the results in task
+    order. With `workers>1` the tasks are spread over a process pool and
+    submitted by decreasing `weights`, so that the largest ones start first.
+    `shared` holds large inputs that are handed to each worker once at
+    startup and are available to `func` through `shared_data()`.
+    """
+    shared = shared or {}
+    if workers<=1:
+        _share(shared)
+        return [func(*task) for task in tasks]
+
+    from concurrent.futures import ProcessPoolExecutor
+    order = np.argsort(-np.asarray(weights), kind='stable') if weights is not None else range(len(tasks))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_share, initargs=(shared,)) as pool:
+        if not profiling.enabled():
+            futures = {ti: pool.submit(func, *tasks[ti]) for ti in order}
+            return [futures[ti].result() for ti in range(len(tasks))]
+        # timers and counters of the workers are merged into this process
+        futures = {ti: pool.submit(profiling.profiled_call, func, *tasks[ti]) for ti in order}
+        results = []
+        for ti in range(len(tasks)):
+            result, recorded = futures[ti].result()
+            profiling.merge(recorded)
+            results.append(result)
+        return results
+
+def system_hashes(counts, totals, *params):
+    """
+    Hash of the inputs of each system: its rows of `counts` and `totals`
+    (systems along the first axis) and the `params` shared by all systems,
+    such as the time bin dates and the fit parameters.
+    """
+    prefix = repr(params).encode()
+    counts = np.ascontiguousarray(counts, dtype=np.int64)
+    totals = np.ascontiguousarray(np.broadcast_to(totals, counts.shape), dtype=np.int64)
+    return [hashlib.sha1(prefix + k.tobytes() + n.tobytes()).hexdigest() for k, n in zip(counts, totals)]
+
+def state_path(state_dir, output):
+    # keyed by the full output path, outputs of the same name in different directories share a state dir
+    key = hashlib.sha1(os.path.normpath(output).encode()).hexdigest()[:12]
+    return os.path.join(state_dir, f"{os.path.basename(output)}.{key}.fits.npz")
+
+def load_fit_state(path):
+    """
+    Fits of a previous run written by `save_fit_state` as a dict mapping the
+    system hash to (val, lower, upper). Empty if there is no state yet.
+    """
+    if not os.path.exists(path):
+        return {}
+    with np.load(path) as state:
+        bounds = np.cumsum(np.concatenate([[0], state["rows"]]))
+        fits = [np.split(state[x], bounds[1:-1]) for x in ["val", "lower", "upper"]]
+        if state["ndim"]==1:
+            fits = [[y[0] for y in x] for x in fits]
+        return dict(zip(state["hashes"], zip(*fits)))
+
+def save_fit_state(path, fits):
+    """
+    Write a dict mapping system hashes to (val, lower, upper) arrays of equal
+    shape, either (T,) or (nodes, T) with a number of nodes that may differ
+    between systems. The file is replaced atomically.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    hashes = list(fits)
+    ndim = np.ndim(fits[hashes[0]][0]) if hashes else 1
+    arrays = [[np.reshape(fits[h][i], (-1, np.shape(fits[h][i])[-1])) for h in hashes] for i in range(3)]
+    val, lower, upper = [np.concatenate(x) if hashes else np.zeros((0, 0)) for x in arrays]
+    with open(path + ".tmp", "wb") as fh:
+        np.savez(fh, hashes=np.array(hashes, dtype=str), rows=np.array([len(x) for x in arrays[0]], dtype=int),
+                 ndim=ndim, val=val, lower=lower, upper=upper)
+    os.replace(path + ".tmp", path)
+
+def _fit_systems(start, stop, stiffness, solver, padding):
+    shared = shared_data()
+    return fit_single_categories(shared["totals"][start:stop], shared["counts"][start:stop],
+                                 stiffness=stiffness, solver=solver, padding=padding)
+
+def fit_single_tables(tensors, stiffness, solver="banded", workers=1, padding=None, state=None):
+    """
+    Fit the systems with enough data of all `tensors` and return one frequency
+    table per tensor. Tensors with the same time bins are solved in one batch.
+    Systems whose counts are unchanged since the fits in `state` (as returned
+    by `load_fit_state`) are copied from it, and `state` is updated in place.
+    """
+    groups = {}
+    for ti, tensor in enumerate(tensors):
+        groups.setdefault(tuple(tensor.dates), []).append(ti)
+
+    tables = [None]*len(tensors)
+    fitted = {}
+    for dates, group in groups.items():
+        batches = [single_category_systems(tensors[ti]) for ti in group]
+        sys_counts = np.concatenate([x[1] for x in batches])
+        sys_totals = np.concatenate([x[2] for x in batches])
+        val, lower, upper = np.zeros((3,) + sys_counts.shape)
+
+        # systems whose inputs are unchanged since the last run are copied from the state
+        hashes = system_hashes(sys_counts, sys_totals, list(dates), stiffness, solver, padding)
+        cached = state or {}
+        todo = np.array([si for si, h in enumerate(hashes) if h not in cached], dtype=int)
+        for si, h in enumerate(hashes):
+            if h in cached:
+                val[si], lower[si], upper[si] = cached[h]
+        profiling.count("systems", len(hashes))
+        profiling.count("systems_cached", len(hashes) - len(todo))
+
+        # one task per geographic category and batch of variants
+        geo_labels = np.array([s[0] for batch in batches for s in batch[0]])[todo]
+        tasks = []
+        for chunk_group in np.split(np.arange(len(geo_labels)), np.flatnonzero(geo_labels[1:]!=geo_labels[:-1]) + 1):
+            for chunk in np.array_split(chunk_group, workers):
+                if len(chunk):
+                    tasks.append((chunk[0], chunk[-1]+1, stiffness, solver, padding))
+        weights = [sys_totals[todo[task[0]:task[1]]].sum() for task in tasks]
+        fits = run_tasks(_fit_systems, tasks, workers=workers, weights=weights,
+                         shared={"counts": sys_counts[todo], "totals": sys_totals[todo]})
+        for task, fit in zip(tasks, fits):
+            index = todo[task[0]:task[1]]
+            val[index], lower[index], upper[index] = fit
+        fitted.update({h: (val[si], lower[si], upper[si]) for si, h in enumerate(hashes)})
+
+        offset = 0
+        for ti, (systems, _, _) in zip(group, batches):
+            sl = slice(offset, offset + len(systems))
+            offset += len(systems)
+            tables[ti] = frequency_table(list(dates), [s[0] for s in systems], None, [s[1] for s in systems],
+                                         sys_counts[sl], sys_totals[sl], val[sl], lower[sl], upper[sl])
+
+    if state is not None:
+        state.clear()
+        state.update(fitted)
+    return tables
 
 
 if __name__=='__main__':
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument("--metadata", type=str, help="filename with metadata")
+    parser.add_argument("--metadata", type=str, help="filename with metadata, optionally compressed (.gz, .xz, .zst)")
+    parser.add_argument("--counts", type=str, help="count cube from aggregate_counts.py to use instead of --metadata")
     parser.add_argument("--frequency-category", type=str, help="field to use for frequency categories")
     parser.add_argument("--geo-categories", nargs='+', type=str, help="field to use for geographic categories")
     parser.add_argument("--days", default=7, type=int, help="number of days in one time bin")
     parser.add_argument("--min-date", type=str, help="date to start frequency calculation")
     parser.add_argument("--output-csv", type=str, help="file for csv output")
     parser.add_argument("--inclusive-clades", type=str, help="whether or not to generate inclusive clade/lineage categories")
+    parser.add_argument("--mutations", nargs='+', type=str, help="mutations or comma separated mutation combinations to fit in one pass, "
+                        "requires a '{mutation}' placeholder in --output-csv")
+    parser.add_argument("--solver", default="banded", choices=["banded", "sparse"], help="linear solver used for the fits")
+    parser.add_argument("--workers", default=1, type=int, help="number of worker processes used for fitting")
+    parser.add_argument("--trim-padding", type=int, help="fit each variant only on the time bins with counts of it "
+                        "and this many bins on either side; the other bins are eliminated exactly")
+    parser.add_argument("--state-dir", type=str, help="directory with the fits of the previous run, only systems "
+                        "with changed counts are fitted again and the state is updated")
+    parser.add_argument("--force", action="store_true", help="fit all systems, ignoring the state of the previous run")
+    parser.add_argument("--profile-json", type=str, help="file for the time, memory and counters of each stage")
 
     args = parser.parse_args()
+    if args.profile_json:
+        profiling.enable()
     stiffness = 5000/args.days
 
-    if args.frequency_category.startswith('mutation-'):
-        d = pl.read_csv(args.metadata, separator='\t', try_parse_dates=False, columns=args.geo_categories + ["aaSubstitutions", 'date'])
-        mutation = args.frequency_category.split('-')[-1]
-        mutations = mutation.split(",")
-        def extract_mut(muts):
-            if type(muts)==str:
-                a = [y for y in muts.split(',') if y in mutations]
-                return ",".join(a) if len(a) else 'WT'
-            else:
-                return 'WT'
-        d = d.with_columns([d["aaSubstitutions",:].map_elements(extract_mut).alias("mutation")])
+    if args.mutations:
+        mutation_sets = args.mutations
+    elif args.frequency_category.startswith('mutation-'):
+        mutation_sets = [args.frequency_category.split('-')[-1]]
+    else:
+        mutation_sets = []
 
-        print(d["mutation"].value_counts())
-        freq_cat = "mutation"
+    if mutation_sets:
+        if len(mutation_sets)>1 and "{mutation}" not in args.output_csv:
+            raise ValueError("--output-csv needs a '{mutation}' placeholder when fitting several mutations")
+        freq_cats = mutation_sets
+        inclusive_clades = ""
     else:
-        d = pl.read_csv(args.metadata, separator='\t', try_parse_dates=False, columns=args.geo_categories + [args.frequency_category, 'date'])
-        freq_cat = args.frequency_category
-    d = d.with_columns(pl.col("date").str.strptime(pl.Date, format="%Y-%m-%d", strict=False))
-    data, totals, counts, time_bins = load_and_aggregate(d, args.geo_categories, freq_cat,
-                                                         bin_size=args.days, min_date=args.min_date, inclusive_clades=args.inclusive_clades)
-
-
-    dates = [time_bins[k] for k in time_bins]
-    geo_cats = set([k[:-1] for k in totals])
-    output_data = []
-    for geo_cat in geo_cats:
-        geo_label = ','.join(geo_cat)
-        frequencies = {}
-        sub_counts = {}
-        sub_totals = {k[-1]:v for k,v in totals.items() if tuple(k[:-1])==geo_cat}
-        for fcat in counts.keys():
-            sub_counts[fcat] = {k[-1]:v for k,v in counts[fcat].items() if tuple(k[:-1])==geo_cat}
-            if sum(sub_counts[fcat].values())>10:
-                frequencies[fcat],A = fit_single_category(sub_totals, sub_counts[fcat],
-                                        sorted(time_bins.keys()), stiffness=stiffness)
-                for k, date in time_bins.items():
-                    output_data.append({"date": date.strftime('%Y-%m-%d'), "region": geo_label, "country": None,
-                                        "count": sub_counts[fcat].get(k, 0), "total": sub_totals.get(k, 0),
-                                        "variant":fcat,
-                                        "freqMi":frequencies[fcat][k]['val'], "freqLo":frequencies[fcat][k]['lower'], "freqUp":frequencies[fcat][k]['upper']})
-
-    df = pl.DataFrame(output_data, schema={'date':str, 'region':str, 'country':str, 'variant':str,
-                                    'count':int, 'total':int,
-                                    'freqMi':float, 'freqLo':float, 'freqUp':float})
-    df.write_csv(args.output_csv, float_precision=4)
+        freq_cats = [args.frequency_category]
+        inclusive_clades = args.inclusive_clades
+
+    # reading includes parsing the dates, which polars does while scanning
+    with profiling.stage("read"):
+        if args.counts:
+            from .aggregate_counts import read_count_cube
+            data = {freq_cat: read_count_cube(args.counts, freq_cat, args.geo_categories) for freq_cat in freq_cats}
+            count_column = "count"
+        else:
+            if mutation_sets:
+                d = scan_metadata(args.metadata, args.geo_categories + ["aaSubstitutions", 'date'], min_date=args.min_date).collect()
+                d = mutation_categories(d, mutation_sets)
+                for mutations in mutation_sets:
+                    print(d[mutations].value_counts())
+            else:
+                d = scan_metadata(args.metadata, args.geo_categories + [args.frequency_category, 'date'], min_date=args.min_date).collect()
+            data = {freq_cat: d for freq_cat in freq_cats}
+            count_column = None
+        profiling.count("rows_read", sum(len(x) for x in data.values()) if args.counts else len(d))
+
+    with profiling.stage("aggregate"):
+        tensors = [aggregate_tensor(data[freq_cat], args.geo_categories, freq_cat,
+                                    bin_size=args.days, min_date=args.min_date, inclusive_clades=inclusive_clades,
+                                    count_column=count_column)[1]
+                   for freq_cat in freq_cats]
+
+    state = None
+    if args.state_dir:
+        with profiling.stage("load_state"):
+            state = {} if args.force else load_fit_state(state_path(args.state_dir, args.output_csv))
+    previous = set(state or ())
+    with profiling.stage("fit"):
+        tables = fit_single_tables(tensors, stiffness, solver=args.solver, workers=args.workers,
+                                   padding=args.trim_padding, state=state)
+    if args.state_dir:
+        print(f"fitted {len(state.keys() - previous)} of {len(state)} systems")
+        with profiling.stage("save_state"):
+            save_fit_state(state_path(args.state_dir, args.output_csv), state)
+
+    with profiling.stage("write"):
+        for freq_cat, df in zip(freq_cats, tables):
+            df.write_csv(args.output_csv.replace("{mutation}", freq_cat), float_precision=4)
+            profiling.count("rows_written", len(df))
+    profiling.write(args.profile_json)
@@ -2,6 +2,7 @@ import matplotlib.pyplot as plt
 import datetime
 import polars  as pl
 import numpy as np
+from . import profiling
 
 if __name__=='__main__':
     import argparse
@@ -11,15 +12,21 @@ if __name__=='__main__':
     parser.add_argument("--country", type=str, help="country to plot")
     parser.add_argument("--max-freq", type=float, help="plot clades above this frequencies")
     parser.add_argument("--output", type=str, help="mask containing `{cat}` to plot")
+    parser.add_argument("--profile-json", type=str, help="write timing and memory of the stages to this json file")
 
     args = parser.parse_args()
+    if args.profile_json:
+        profiling.enable()
 
+    profiling.mark("read")
     d = pl.read_csv(args.frequencies, try_parse_dates=True, dtypes={
             "variant": pl.Categorical, 
             "region": pl.Categorical, 
             "country": pl.Categorical
         })
+    profiling.count("rows_read", len(d))
 
+    profiling.mark("plot")
     region = args.region.replace('_', ' ')
     country = args.country.replace('-', ' ')
     clades = sorted(d['variant'].fill_null('other').unique())
@@ -42,3 +49,4 @@ if __name__=='__main__':
     fig.autofmt_xdate()
     plt.legend(loc=2)
     plt.savefig(args.output)
+    profiling.write(args.profile_json)
@@ -2,6 +2,7 @@ import matplotlib.pyplot as plt
 import polars as pl
 import numpy as np
 import json
+from . import profiling
 
 if __name__=='__main__':
     import argparse
@@ -13,8 +14,11 @@ if __name__=='__main__':
     parser.add_argument("--auspice-config", help="Auspice config JSON with custom colorings for clades defined in a scale")
     parser.add_argument("--coloring-field", default="clade_membership", help="name of the coloring field in the given Auspice config JSON to use for the color scale")
     parser.add_argument("--output", type=str, help="mask containing `{cat}` to plot")
+    parser.add_argument("--profile-json", type=str, help="write timing and memory of the stages to this json file")
 
     args = parser.parse_args()
+    if args.profile_json:
+        profiling.enable()
 
     color_map = {}
     if args.auspice_config:
@@ -34,7 +38,10 @@ if __name__=='__main__':
                     break
 
 
+    profiling.mark("read")
     d = pl.read_csv(args.frequencies, try_parse_dates=True)
+    profiling.count("rows_read", len(d))
+    profiling.mark("plot")
 
     if args.clades:
         clades = args.clades
@@ -81,3 +88,4 @@ if __name__=='__main__':
     axs[0,0].legend(loc=3, ncol=2)
     plt.tight_layout()
     plt.savefig(args.output)
+    profiling.write(args.profile_json)
@@ -1,6 +1,7 @@
 import matplotlib.pyplot as plt
 import polars as pl
 import numpy as np
+from . import profiling
 
 if __name__=='__main__':
     import argparse
@@ -9,9 +10,16 @@ if __name__=='__main__':
     parser.add_argument("--region", type=str, help="regions to plot")
     parser.add_argument("--max-freq", type=float, help="plot clades above this frequencies")
     parser.add_argument("--output", type=str, help="mask containing `{cat}` to plot")
+    parser.add_argument("--profile-json", type=str, help="write timing and memory of the stages to this json file")
 
     args = parser.parse_args()
+    if args.profile_json:
+        profiling.enable()
+
+    profiling.mark("read")
     d = pl.read_csv(args.frequencies, try_parse_dates=True, infer_schema_length=1_000_000)
+    profiling.count("rows_read", len(d))
+    profiling.mark("plot")
     clades = sorted(d['variant'].unique())
     region = args.region.replace('_', ' ')
     d = d.filter(pl.col('region')==region)
@@ -33,3 +41,4 @@ if __name__=='__main__':
     fig.autofmt_xdate()
     plt.legend(loc=2)
     plt.savefig(args.output)
+    profiling.write(args.profile_json)
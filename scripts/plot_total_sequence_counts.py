@@ -1,8 +1,9 @@
 import polars as  pl
 from datetime import datetime,timedelta
 import numpy as np
-from fit_single_frequencies import load_and_aggregate
+from .fit_single_frequencies import aggregate_tensor
 import  matplotlib.pyplot as plt
+from . import profiling
 
 if __name__=='__main__':
     import argparse
@@ -12,31 +13,41 @@ if __name__=='__main__':
     parser.add_argument("--days", default=7, type=int, help="number of days in one time bin")
     parser.add_argument("--min-date", type=str, help="date to start frequency calculation")
     parser.add_argument("--output-plot", type=str, help="file for json output")
+    parser.add_argument("--profile-json", type=str, help="write timing and memory of the stages to this json file")
     fs=14
     args = parser.parse_args()
+    if args.profile_json:
+        profiling.enable()
 
     plt.figure(figsize=(10,6))
     for fname, name in zip(args.metadata, args.names):
+        profiling.mark("read")
         d = pl.read_csv(fname, sep='\t', try_parse_dates=False, columns=['date'])
+        profiling.count("rows_read", len(d))
 
         d = d.with_columns([pl.col("date").str.strptime(pl.Date, format="%Y-%m-%d", strict=False),
                             pl.col('date').apply(lambda x:'dummy').alias('dummy')])
 
-        data, totals, counts, time_bins = load_and_aggregate(d, ['dummy'], 'dummy',
-                                                            bin_size=args.days, min_date=args.min_date)
+        profiling.mark("aggregate")
+        data, tensor = aggregate_tensor(d, ['dummy'], 'dummy', bin_size=args.days, min_date=args.min_date)
+        dates, totals = np.array(tensor.dates), tensor.totals[0]
         if 'H1N1pdm' in name:
-            time_bins = {k:v for k,v in time_bins.items() if v>datetime(2009,3,1) - timedelta(days=args.days)}
+            keep = dates>datetime(2009,3,1) - timedelta(days=args.days)
+            dates, totals = dates[keep], totals[keep]
         if 'SARS-CoV-2' in name:
-            time_bins = {k:v for k,v in time_bins.items() if v>datetime(2019,12,1) - timedelta(days=args.days)}
+            keep = dates>datetime(2019,12,1) - timedelta(days=args.days)
+            dates, totals = dates[keep], totals[keep]
         if 'Yam' not in name:
-            time_bins = {k:v for k,v in list(time_bins.items())[:-1]}
+            dates, totals = dates[:-1], totals[:-1]
 
-        plt.plot(time_bins.values(), [totals[('dummy', x)] for x in time_bins], label=name, lw=2)
+        plt.plot(dates, totals, label=name, lw=2)
 
+    profiling.mark("plot")
     plt.tight_layout()
     plt.yscale('log')
     plt.legend(loc=2, fontsize=fs)
     plt.tick_params(labelsize=0.8*fs)
     plt.savefig(args.output_plot)
+    profiling.write(args.profile_json)
 
 
@@ -1,21 +1,29 @@
 """
 Script to aggregate results from a lower hierarchy to a higher one
 Input:
-    - variant/country frequences from fit_hierarchical_frequencies
+    - variant/country frequences from fit_hierarchical_frequencies,
+      one or several files (e.g. all lineage/segment combinations)
     - country to population mapping
     - country to region mapping
 Output:
-    - csv file similar to the one from fit_hierarchical_frequencies
+    - csv file per input similar to the one from fit_hierarchical_frequencies
       but with higher level estimate replaced by pop weighted average
+    - optionally, the population of each country and region as a cache,
+      written when no fit results are given
+All inputs are aggregated in one lazy query, regions and the global level together.
 """
 
-from typing import Annotated
+import os
+import tempfile
+from typing import Annotated, List, Optional
 
 import polars as pl
 from polars import col as c
 import typer
 from typer import Option
 
+from . import profiling
+
 
 def read_tsv(path, *args, **kwargs):
     """
@@ -46,6 +54,188 @@ def country_region_population(
     return df_out
 
 
+FIT_COLUMNS = {
+    "date": pl.Utf8,
+    "region": pl.Utf8,
+    "country": pl.Utf8,
+    "variant": pl.Utf8,
+    "count": pl.Int64,
+    "total": pl.Int64,
+    "freqMi": pl.Float64,
+    "freqLo": pl.Float64,
+    "freqUp": pl.Float64,
+}
+
+
+def read_population_tables(country_to_population_path, country_to_region_path):
+    """
+    Read the population and the region of each country
+    ### Output
+    country_to_population: country, population
+    country_to_region: country, region
+    """
+    country_to_population = read_tsv(country_to_population_path).select(
+        country=c("iso3"), population=c("population")
+    )
+    country_to_region = read_tsv(country_to_region_path).select(
+        country=c("iso3"), region=c("continent")
+    )
+    return country_to_population, country_to_region
+
+
+def read_population_table(country_to_population_path, country_to_region_path, cache=None):
+    """
+    Population of each country and its region, see country_region_population
+    With `cache` (Arrow IPC file written by write_population_table), the table is
+    read from the cache if it is newer than both inputs and computed otherwise.
+    The cache is never written here, so concurrent readers leave it untouched.
+    """
+    if cache and os.path.exists(cache) and os.path.getmtime(cache) >= max(
+        os.path.getmtime(country_to_population_path), os.path.getmtime(country_to_region_path)
+    ):
+        return pl.read_ipc(cache, memory_map=False)
+    return country_region_population(
+        *read_population_tables(country_to_population_path, country_to_region_path)
+    )
+
+
+def write_population_table(country_to_population_path, country_to_region_path, cache):
+    """
+    Compute the population table and write it to the `cache` Arrow IPC file
+    through a temporary file of its own, replacing the cache atomically
+    """
+    population = country_region_population(
+        *read_population_tables(country_to_population_path, country_to_region_path)
+    )
+    os.makedirs(os.path.dirname(cache) or ".", exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache) or ".", prefix=os.path.basename(cache) + ".")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            population.write_ipc(fh)
+        os.replace(tmp, cache)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return population
+
+
+def population_with_other(fit_results: pl.LazyFrame, population: pl.LazyFrame, by: List[str]) -> pl.LazyFrame:
+    """
+    Population of the countries in the fit results of each dataset (identified by the
+    columns `by`) and of a country "other" per region for the countries not in the data
+    ### Output
+    columns: by..., country, region, country_population, region_population
+    """
+    # Other country gets difference between region and sum(country).over(region)
+    # Each region has represented population (with other counting 0)
+    present = (
+        fit_results.select(by + ["country"])
+        .unique()
+        .join(population, on="country")
+        .select(by + ["country", "region", "country_population", "region_population"])
+    )
+    other = present.group_by(by + ["region"]).agg(
+        country=pl.lit("other"),
+        country_population=c("region_population").first() - c("country_population").sum(),
+        region_population=c("region_population").first(),
+    )
+    return pl.concat([present, other.select(present.columns)])
+
+
+def prepared_plan(fit_results: pl.LazyFrame, population: pl.LazyFrame, by: List[str]) -> pl.LazyFrame:
+    """
+    Country level rows of the fit results with the populations of their country and region
+    """
+    return fit_results.filter(
+        (c("country") != "?") & (c("country") != c("region"))
+    ).join(population_with_other(fit_results, population, by), on=by + ["region", "country"], how="left")
+
+
+def weighted_plan(prepared: pl.LazyFrame, by: List[str]) -> pl.LazyFrame:
+    """
+    Population weighted frequencies of each region and of all regions ("global")
+    Frequency of special country "other" is used for countries not represented in data
+    Weighted error is calculated as weighted average of squared errors
+    """
+    squared_error = (
+        pl.max_horizontal([c("freqMi") - c("freqLo"), c("freqUp") - c("freqMi")]) ** 2
+    )
+    prepared = prepared.filter(c("country") != c("region")).with_columns(
+        weight=c("country_population") / c("region_population"),
+    )
+    regional = (
+        prepared.group_by(by + ["date", "region", "variant"])
+        .agg(
+            freqMi=(c("freqMi") * c("weight")).sum(),
+            freqErr=(squared_error * c("weight")).sum().sqrt(),
+            region_population=c("region_population").max(),
+        )
+        .with_columns(
+            freqLo=pl.max_horizontal([c("freqMi") - c("freqErr"), 0]),
+            freqUp=pl.min_horizontal([c("freqMi") + c("freqErr"), 1]),
+        )
+    )
+
+    global_population = (
+        prepared.group_by(by + ["region"])
+        .agg(c("region_population").max())
+        .group_by(by)
+        .agg(global_population=c("region_population").sum())
+    )
+    global_level = (
+        regional.join(global_population, on=by)
+        .with_columns(weight=c("region_population") / c("global_population"))
+        .group_by(by + ["date", "variant"])
+        .agg(
+            freqMi=(c("freqMi") * c("weight")).sum(),
+            freqErr=(squared_error * c("weight")).sum().sqrt(),
+        )
+        .with_columns(
+            freqLo=pl.max_horizontal([c("freqMi") - c("freqErr"), 0]),
+            freqUp=pl.min_horizontal([c("freqMi") + c("freqErr"), 1]),
+            region=pl.lit("global"),
+        )
+    )
+
+    columns = by + ["date", "region", "variant", "freqMi", "freqLo", "freqUp"]
+    return pl.concat([regional.select(columns), global_level.select(columns)])
+
+
+def population_weighted_plan(fit_results: pl.LazyFrame, population: pl.LazyFrame, by: List[str]) -> pl.LazyFrame:
+    """
+    Population weighted frequencies of each region and of all regions ("global")
+    from the country level fit results, with the counts and totals of the regions.
+    `fit_results` may hold several datasets identified by the columns `by`, which
+    are aggregated separately
+    """
+    # Filter out unknown regions
+    fit_results = fit_results.filter(c("region") != "?").filter(c("region") != "Unknown")
+
+    weighted = weighted_plan(prepared_plan(fit_results, population, by), by).with_columns(
+        c("region").alias("country")
+    )
+
+    # Add global rows to fit_results with count/total
+    region_counts = fit_results.filter(c("country") == c("region")).select(
+        by + ["date", "region", "variant", "count", "total"]
+    )
+    global_counts = (
+        region_counts.group_by(by + ["date", "variant"])
+        .agg(count=c("count").sum(), total=c("total").sum())
+        .with_columns(region=pl.lit("global"))
+    )
+    # Join count and total from original data
+    return weighted.join(
+        pl.concat([region_counts, global_counts.select(region_counts.columns)]),
+        on=by + ["region", "variant", "date"],
+        how="left",
+    ).sort(by + ["region", "variant", "date"])
+
+
+def _single_dataset(plan, df: pl.DataFrame, *args):
+    return plan(df.lazy().with_columns(dataset=pl.lit(0)), *args, ["dataset"]).collect().drop("dataset")
+
+
 def prepare_data(
     df: pl.DataFrame,
     country_to_population: pl.DataFrame,
@@ -67,61 +257,18 @@ def prepare_data(
     Input country_to_region should have the following columns:
         - country
         - region
-    Output DataFrame will have the following columns:
-        - date
-        - region
-        - country
-        - variant
-        - freqMi
-        - freqLo
-        - freqUp
+    Output DataFrame will have the columns of df and
         - country_population
         - region_population
     """
-    # Other country gets difference between region and sum(country).over(region)
-    # Each region has represented population (with other counting 0)
-    missing_population = (
-        country_region_population(country_to_population, country_to_region)
-        .filter(c("country").is_in(df.get_column("country")))
-        .with_columns(
-            missing_population=c("region_population")
-            - (c("country_population").sum().over("region")),
-        )
-        # .with_columns(
-        #     missing_population=c("region_population")
-        #     - c("represented_population")
-        # )
-    )
-    # Add "other" rows: like df.exclude(["country","country_population"]) with added country="other", country_population=missing_population
-    population_with_other = missing_population.vstack(
-        missing_population.with_columns(
-            country=pl.lit("other"),
-            country_population=c("missing_population"),
-        ).unique()
-    ).select(pl.exclude("missing_population"))
-
-    df_out = df.filter(
-        (c("country") != "?") & (c("country") != c("region"))
-    ).join(population_with_other, on=["region", "country"], how="left")
-
-    return df_out
+    population = country_region_population(country_to_population, country_to_region)
+    return _single_dataset(prepared_plan, df, population.lazy())
 
 
 def weighted_average(df: pl.DataFrame):
     """
     Calculates population weighted average for a region
-    Frequency of special country "other" is used for countries not represented in data
-    Weighted error is calculated as weighted average of squared errors
-    Input DataFrame should have the following columns:
-        - date
-        - region
-        - country
-        - variant
-        - freqMi
-        - freqLo
-        - freqUp
-        - country_population
-        - region_population
+    Input DataFrame should have the columns of the output of prepare_data
     Output DataFrame will have the following columns:
         - date
         - region
@@ -130,76 +277,21 @@ def weighted_average(df: pl.DataFrame):
         - freqLo
         - freqUp
     """
+    return _single_dataset(weighted_plan, df)
 
-    df = (
-        df.filter(c("country") != c("region"))
-        .with_columns(
-            weight=c("country_population") / c("region_population"),
-        )
-        .with_columns(
-            freqMi_pop_product=c("freqMi") * c("weight"),
-            freqErr_pop_product=(
-                pl.max_horizontal([c("freqMi") - c("freqLo"), c("freqUp") - c("freqMi")])
-                ** 2
-            )
-            * c("weight"),
-        )
-        .group_by(["date", "region", "variant"])
-        .agg(
-            freqMi=c("freqMi_pop_product").sum(),
-            freqErr=c("freqErr_pop_product").sum().sqrt(),
-            region_population=c("region_population").first(),
-        )
-        .select(
-            ["date", "region", "variant", "freqMi", "region_population"],
-            freqLo=pl.max_horizontal([c("freqMi") - c("freqErr"), 0]),
-            freqUp=pl.min_horizontal([c("freqMi") + c("freqErr"), 1]),
-            global_population=(
-                df.unique("region").get_column("region_population").sum()
-            ),
-        )
-    )
-
-    global_df = (
-        df.with_columns(
-            weight=c("region_population") / c("global_population"),
-        )
-        .with_columns(
-            freqMi_pop_product=c("freqMi") * c("weight"),
-            freqErr_pop_product=(
-                pl.max_horizontal([c("freqMi") - c("freqLo"), c("freqUp") - c("freqMi")])
-                ** 2
-            )
-            * c("weight"),
-        )
-        .group_by(["date", "variant"])
-        .agg(
-            freqMi=c("freqMi_pop_product").sum(),
-            freqErr=c("freqErr_pop_product").sum().sqrt(),
-        )
-        .select(
-            ["date", "variant", "freqMi"],
-            freqLo=pl.max_horizontal([c("freqMi") - c("freqErr"), 0]),
-            freqUp=pl.min_horizontal([c("freqMi") + c("freqErr"), 1]),
-            region=pl.lit("global"),
-        )
-    )
 
-    df = pl.concat(
-        [
-            df.select(pl.exclude(["region_population", "global_population"])),
-            global_df,
-        ],
-        how="diagonal",
-    )
-
-    return df
+def population_weighted_frequencies(fit_results: pl.DataFrame, population: pl.DataFrame) -> pl.DataFrame:
+    """
+    Population weighted frequencies of a single fit results table, see population_weighted_plan
+    `population` is the output of country_region_population (or read_population_table)
+    """
+    return _single_dataset(population_weighted_plan, fit_results, population.lazy())
 
 
 def main(
     _fit_results: Annotated[
-        str, Option("--fit-results")
-    ] = "results/h3n2/region-country-frequencies.csv",
+        List[str], Option("--fit-results", help="fit results, can be given several times")
+    ] = [],
     _country_to_population: Annotated[
         str, Option("--country-to-population")
     ] = "defaults/iso3_to_pop.tsv",
@@ -207,8 +299,15 @@ def main(
         str, Option("--country-to-region")
     ] = "profiles/flu/iso3_to_region.tsv",
     output_csv: Annotated[
-        str, Option()
-    ] = "results/h3n2/region-country-frequencies-pop-weighted.csv",
+        List[str], Option(help="output file for each --fit-results, in the same order")
+    ] = [],
+    population_cache: Annotated[
+        Optional[str], Option(help="Arrow file with the population table, read if up to date; "
+                     "written instead if no --fit-results are given")
+    ] = None,
+    profile_json: Annotated[
+        str, Option(help="write timing and memory of the stages to this json file")
+    ] = None,
 ):
     """
     Fit results need to have columns:
@@ -222,59 +321,41 @@ def main(
     - freqLo
     - freqUp
     """
+    if len(output_csv) != len(_fit_results):
+        raise typer.BadParameter("give one --output-csv per --fit-results")
 
-    # Filter out unknown regions
-    fit_results = pl.read_csv(_fit_results).filter(c("region") != "?").filter(c("region") != "Unknown")
-    country_to_population = read_tsv(_country_to_population).select(
-        country=c("iso3"), population=c("population")
-    )
-    country_to_region = read_tsv(_country_to_region).select(
-        country=c("iso3"), region=c("continent")
-    )
+    if profile_json:
+        profiling.enable()
 
-    # Prepare data
-    prepped_data = prepare_data(
-        fit_results, country_to_population, country_to_region
-    )
+    if not _fit_results:
+        if population_cache:
+            profiling.mark("write_population")
+            write_population_table(_country_to_population, _country_to_region, population_cache)
+        profiling.write(profile_json)
+        return
 
+    profiling.mark("read_population")
+    population = read_population_table(_country_to_population, _country_to_region, cache=population_cache)
 
-    # Calculate weighted average
-    weighted = weighted_average(prepped_data).with_columns(
-        c("region").alias("country")
+    # One plan for all files, each file is a dataset of its own
+    profiling.mark("aggregate")
+    fit_results = pl.concat(
+        [
+            pl.scan_csv(path, dtypes=FIT_COLUMNS).select(
+                [c(x).cast(dtype) for x, dtype in FIT_COLUMNS.items()]
+            ).with_columns(dataset=pl.lit(i))
+            for i, path in enumerate(_fit_results)
+        ]
     )
-
     pl.Config.set_tbl_cols(12)
-
-    # Add global rows to fit_results with count/total
-    global_fit_results = (
-        fit_results.filter(c("country") == c("region"))
-        .select(
-            ["date", "variant", "count", "total"],
-        )
-        .group_by(["date", "variant"])
-        .agg(
-            count=c("count").sum(),
-            total=c("total").sum(),
-            region=pl.lit("global"),
-        )
-    )
-    # Join count and total from original data
-    df = weighted.join(
-        pl.concat(
-            [
-                fit_results.filter(c("country") == c("region")).select(
-                    ["date", "region", "variant", "count", "total"]
-                ),
-                global_fit_results,
-            ],
-            how="diagonal",
-        ),
-        on=["region", "variant", "date"],
-        how="left",
-    )
+    df = population_weighted_plan(fit_results, population.lazy(), ["dataset"]).collect()
 
     # Write out the data
-    df.write_csv(output_csv, float_precision=5)
+    profiling.mark("write")
+    for i, path in enumerate(output_csv):
+        df.filter(c("dataset") == i).drop("dataset").write_csv(path, float_precision=5)
+    profiling.count("rows_written", len(df))
+    profiling.write(profile_json)
 
 
 if __name__ == "__main__":
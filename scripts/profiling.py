@@ -0,0 +1,178 @@
+"""
+Instrumentation of the scripts, enabled by their --profile-json option
+- stages: wall time, CPU time and peak memory of the named steps of a script
+  (e.g. reading, aggregation, fitting, writing), either as a `stage` context
+  or started one after the other with `mark`
+- timers: accumulated wall and CPU time of steps that run many times, such as
+  the assembly, solve and confidence intervals of each system
+- counters: rows read, systems solved, matrix sizes and nonzeros
+Timers and counters of tasks run in worker processes by `run_tasks` are
+merged into the main process. Unless `enable` was called, nothing is recorded.
+"""
+
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+_profile = None
+_disabled = nullcontext()
+
+
+def reset_peak_rss():
+    # on Linux, the high water mark of the resident set can be reset per process
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+    except OSError:
+        pass
+
+def rss(field="VmHWM"):
+    """
+    Peak resident set size in bytes since the last `reset_peak_rss` (since
+    the start of the process where it cannot be reset). With `field` VmRSS,
+    the current resident set size, where available.
+    """
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return max_rss()
+
+def max_rss(who=resource.RUSAGE_SELF):
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss if sys.platform=="darwin" else maxrss*1024
+
+def children_cpu_time():
+    # CPU time of finished child processes, e.g. the workers of a process pool
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+class Profile:
+    """
+    Stages, timers and counters of one run.
+    """
+    def __init__(self):
+        self.start = time.perf_counter(), time.process_time(), children_cpu_time()
+        self.stages = []
+        self.timers = {}
+        self.counters = {}
+        self.current = None
+
+    def _begin(self, name):
+        reset_peak_rss()
+        return name, rss("VmRSS"), time.perf_counter(), time.process_time(), children_cpu_time(), {}
+
+    def _end(self, begun):
+        name, start_rss, wall, cpu, children, info = begun
+        self.stages.append({"stage": name, "wall_s": time.perf_counter() - wall,
+                            "cpu_s": time.process_time() - cpu,
+                            "children_cpu_s": children_cpu_time() - children,
+                            "start_rss_mb": start_rss/2**20, "peak_rss_mb": rss()/2**20, **info})
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Record the stage `name`. Yields a dict of further fields for its record.
+        """
+        begun = self._begin(name)
+        try:
+            yield begun[-1]
+        finally:
+            self._end(begun)
+
+    def mark(self, name=None):
+        """
+        End the stage started by the last `mark` and start the stage `name`,
+        for scripts that run their stages one after the other.
+        """
+        if self.current is not None:
+            self._end(self.current)
+            self.current = None
+        if name is not None:
+            self.current = self._begin(name)
+
+    @contextmanager
+    def timer(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            calls, wall_s, cpu_s = self.timers.get(name, (0, 0.0, 0.0))
+            self.timers[name] = (calls + 1, wall_s + time.perf_counter() - wall, cpu_s + time.process_time() - cpu)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def merge(self, timers, counters):
+        for name, (calls, wall_s, cpu_s) in timers.items():
+            before = self.timers.get(name, (0, 0.0, 0.0))
+            self.timers[name] = (before[0] + calls, before[1] + wall_s, before[2] + cpu_s)
+        for name, value in counters.items():
+            self.count(name, value)
+
+    def summary(self, **info):
+        self.mark()
+        wall, cpu, children = self.start
+        peak_rss = max([max_rss()/2**20] + [x["peak_rss_mb"] for x in self.stages])
+        return {"script": os.path.basename(sys.argv[0]), "argv": sys.argv[1:], **info,
+                "wall_s": time.perf_counter() - wall, "cpu_s": time.process_time() - cpu,
+                "children_cpu_s": children_cpu_time() - children,
+                "peak_rss_mb": peak_rss, "children_peak_rss_mb": max_rss(resource.RUSAGE_CHILDREN)/2**20,
+                "stages": self.stages,
+                "timers": {name: {"calls": calls, "wall_s": wall_s, "cpu_s": cpu_s}
+                           for name, (calls, wall_s, cpu_s) in self.timers.items()},
+                "counters": self.counters}
+
+
+def enable():
+    """
+    Start recording, discarding anything recorded before. Returns the profile.
+    """
+    global _profile
+    _profile = Profile()
+    return _profile
+
+def enabled():
+    return _profile is not None
+
+def stage(name):
+    return _profile.stage(name) if _profile is not None else nullcontext({})
+
+def mark(name=None):
+    if _profile is not None:
+        _profile.mark(name)
+
+def timer(name):
+    return _profile.timer(name) if _profile is not None else _disabled
+
+def count(name, value=1):
+    if _profile is not None:
+        _profile.count(name, value)
+
+def merge(recorded):
+    if _profile is not None:
+        _profile.merge(*recorded)
+
+def profiled_call(func, *args):
+    """
+    Evaluate `func(*args)` in a worker process with recording enabled and
+    return the result along with the timers and counters for `merge`.
+    """
+    profile = enable()
+    return func(*args), (profile.timers, profile.counters)
+
+def write(path, **info):
+    """
+    Write the summary of the recorded profile as json, if enabled.
+    """
+    if _profile is None or not path:
+        return
+    with open(path, "w") as fh:
+        json.dump(_profile.summary(**info), fh, indent=2)
@@ -4,16 +4,22 @@ from treetime.utils import ambiguous_date_to_date_range, numeric_date, datestrin
 from datetime import datetime
 import numpy as np
 from scipy.stats import scoreatpercentile
+from . import profiling
 
 if __name__=="__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--metadata", type=str)
     parser.add_argument("--evolutionary-rate", type=float, help="Evolutionary rate in subs/year", default=5)
+    parser.add_argument("--profile-json", type=str, help="write timing and memory of the stages to this json file")
 
     args = parser.parse_args()
+    if args.profile_json:
+        profiling.enable()
 
+    profiling.mark("read")
     df = pl.read_csv(args.metadata, separator='\t')
+    profiling.count("rows_read", len(df))
     #.select(["strain", "date", "date_submitted",
     #                                                        "aaSubstitutions",	"substitutions",
     #                                                        "privateNucMutations.reversionSubstitutions",
@@ -28,6 +34,7 @@ if __name__=="__main__":
     revSubs_i = df.columns.index("privateNucMutations.reversionSubstitutions")
     strain_groups = defaultdict(list)
 
+    profiling.mark("group")
     for v in df.iter_rows():
         n_priv_muts = 0
         if v[subs_i] is None:
@@ -50,6 +57,9 @@ if __name__=="__main__":
 
     strains_by_size = sorted(strain_groups.items(), reverse=True, key=lambda x: len(x[1]))
 
+    profiling.count("groups", len(strain_groups))
+
+    profiling.mark("outliers")
     bad_dates = []
     early_outliers = {}
     late_outliers = {}
@@ -78,9 +88,11 @@ if __name__=="__main__":
                     late_outliers[strain] = (d, percentiles[1], allowed_range[1], subdate, offset)
 
 
+    profiling.mark("write")
     print("\t".join(["strain", "date", "cutoff", "typical_date", "submission_date", "mutation_offset"]))
     for strain, (d, typical_date, cutoff, subdate, offset) in early_outliers.items():
         print("\t".join([strain, datestring_from_numeric(d),
                         datestring_from_numeric(cutoff),
                         datestring_from_numeric(typical_date),
                         datestring_from_numeric(subdate) if subdate else '?']) + f'\t{offset:1.1f}')
+    profiling.write(args.profile_json)
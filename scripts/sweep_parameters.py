@@ -0,0 +1,154 @@
+"""
+Script to choose the smoothing parameters of the frequency fits
+- time bins are split into k folds (every k-th bin belongs to the same fold)
+- each fold is fitted with its bins held out and scored by the binomial
+  log-likelihood of the held-out counts
+- grids of stiffness, pseudo-counts and (hierarchical model) mu are all
+  scored on the same aggregated counts; the hierarchical model takes any
+  number of geographic levels
+- outputs a table with the scores of every setting and the fit with the best one
+"""
+
+import itertools
+
+import numpy as np
+import polars as pl
+
+from . import profiling
+from .fit_hierarchical_frequencies import fit_hierarchical_table, geo_tree, node_sums, solve_geo_tree
+from .fit_single_frequencies import (aggregate_tensor, fit_single_categories, frequency_table, scan_metadata,
+                                    single_category_systems, solve_tridiagonal, tridiagonal_system)
+
+
+def fold_masks(n_tp, folds):
+    """
+    Boolean array of shape (folds, n_tp) marking the held-out bins of each fold.
+    """
+    return (np.arange(n_tp)[None,:] % folds)==np.arange(folds)[:,None]
+
+def binomial_log_likelihood(freq, counts, totals, eps=1e-6):
+    p = np.clip(freq, eps, 1-eps)
+    return counts*np.log(p) + (totals - counts)*np.log(1-p)
+
+def sweep_single(sys_counts, sys_totals, grid, folds=5):
+    """
+    Held-out log-likelihood of the single category model for each
+    (stiffness, pc) setting in `grid`. All folds and systems of a setting
+    are solved in one batch.
+    """
+    n_tp = sys_counts.shape[-1]
+    masks = fold_masks(n_tp, folds)[:,None,:]
+    train_counts = np.where(masks, 0, sys_counts[None])
+    train_totals = np.where(masks, 0, sys_totals[None])
+
+    scores = []
+    for stiffness, pc in grid:
+        diag, off, b = tridiagonal_system(train_totals, train_counts, stiffness, pc=pc)
+        val = solve_tridiagonal(diag, off, b, variance=False)
+        ll = binomial_log_likelihood(val, sys_counts[None], sys_totals[None])
+        scores.append(ll[np.broadcast_to(masks, ll.shape)].sum())
+    return np.array(scores)
+
+def sweep_hierarchical(tensor, grid, folds=5):
+    """
+    Held-out log-likelihood of the hierarchical model for each
+    (stiffness, pc, mu) setting in `grid`, scored on the categories fitted
+    with their own data (the leaves of `geo_tree`) of a `CountTensor` with
+    any number of geographic levels. The trees, and with them the pooling
+    of small categories, are built once on the full data. Only the
+    frequencies are solved, without variances.
+    """
+    masks = fold_masks(len(tensor.time_bins), folds)
+    scores = np.zeros(len(grid))
+    for sl in tensor.geo_slices().values():
+        nodes = geo_tree(tensor.geo[sl], tensor.totals[sl].sum(axis=-1))
+        # "other" enters the fit without data and is not scored
+        scored = [ni for ni, x in enumerate(nodes) if x["leaf"] and len(x["fit_units"])]
+        totals = node_sums(nodes, tensor.totals[sl], key="fit_units")
+        for fold_mask in masks:
+            train_totals = np.where(fold_mask, 0, totals)
+            # trees without training data (e.g. all categories pooled) have no fit to score
+            if not train_totals[scored].any():
+                continue
+            for counts in node_sums(nodes, tensor.counts[sl].transpose(1, 0, 2), key="fit_units"):
+                train_counts = np.where(fold_mask, 0, counts)
+                for gi, (stiffness, pc, mu) in enumerate(grid):
+                    freq = solve_geo_tree(nodes, train_totals, train_counts, stiffness, stiffness, mu, pc=pc,
+                                          variance=False)
+                    ll = binomial_log_likelihood(np.clip(freq[scored], 0, 1), counts[scored], totals[scored])
+                    scores[gi] += ll[:, fold_mask].sum()
+    return scores
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--metadata", type=str, help="filename with metadata, optionally compressed (.gz, .xz, .zst)")
+    parser.add_argument("--counts", type=str, help="count cube from aggregate_counts.py to use instead of --metadata")
+    parser.add_argument("--frequency-category", type=str, help="field to use for frequency categories")
+    parser.add_argument("--geo-categories", nargs='+', type=str, help="field to use for geographic categories")
+    parser.add_argument("--days", default=7, type=int, help="number of days in one time bin")
+    parser.add_argument("--min-date", type=str, help="date to start frequency calculation")
+    parser.add_argument("--inclusive-clades", type=str, help="whether or not to generate inclusive clade/lineage categories")
+    parser.add_argument("--model", default="single", choices=["single", "hierarchical"], help="frequency model to tune")
+    parser.add_argument("--stiffness", nargs='+', type=float, help="stiffness values to score, default 5000/days")
+    parser.add_argument("--pc", nargs='+', default=[3.0], type=float, help="pseudo-counts to score")
+    parser.add_argument("--mu", nargs='+', default=[5.0], type=float, help="minor category penalties to score (hierarchical model)")
+    parser.add_argument("--folds", default=5, type=int, help="number of cross-validation folds over time bins")
+    parser.add_argument("--output-scores", type=str, help="tsv file with the score of each setting")
+    parser.add_argument("--output-csv", type=str, help="csv file with the fit using the best setting")
+    parser.add_argument("--profile-json", type=str, help="write timing and memory of the stages to this json file")
+
+    args = parser.parse_args()
+    if args.profile_json:
+        profiling.enable()
+
+    freq_cat = args.frequency_category
+    # dates are parsed while scanning, so reading includes the date parsing
+    profiling.mark("read")
+    if args.counts:
+        from .aggregate_counts import read_count_cube
+        d = read_count_cube(args.counts, freq_cat, args.geo_categories)
+        count_column = "count"
+    else:
+        d = scan_metadata(args.metadata, args.geo_categories + [freq_cat, 'date'], min_date=args.min_date).collect()
+        count_column = None
+    profiling.count("rows_read", len(d))
+
+    profiling.mark("aggregate")
+    _, tensor = aggregate_tensor(d, args.geo_categories, freq_cat,
+                                 bin_size=args.days, min_date=args.min_date, inclusive_clades=args.inclusive_clades,
+                                 count_column=count_column)
+    stiffness_values = args.stiffness or [5000/args.days]
+
+    profiling.mark("sweep")
+    if args.model=="single":
+        grid = list(itertools.product(stiffness_values, args.pc))
+        systems, sys_counts, sys_totals = single_category_systems(tensor)
+        scores = sweep_single(sys_counts, sys_totals, grid, folds=args.folds)
+        grid = [(stiffness, pc, None) for stiffness, pc in grid]
+    else:
+        grid = list(itertools.product(stiffness_values, args.pc, args.mu))
+        scores = sweep_hierarchical(tensor, grid, folds=args.folds)
+
+    score_table = pl.DataFrame({"stiffness": [g[0] for g in grid], "pc": [g[1] for g in grid],
+                                "mu": pl.Series([g[2] for g in grid], dtype=pl.Float64),
+                                "log_likelihood": scores})
+    print(score_table.sort("log_likelihood", descending=True))
+    if args.output_scores:
+        score_table.write_csv(args.output_scores, separator='\t')
+
+    profiling.count("settings", len(grid))
+    stiffness, pc, mu = grid[int(np.argmax(scores))]
+    print(f"best setting: stiffness={stiffness}, pc={pc}" + (f", mu={mu}" if mu is not None else ""))
+    if args.output_csv:
+        profiling.mark("fit")
+        if args.model=="single":
+            val, lower, upper = fit_single_categories(sys_totals, sys_counts, stiffness=stiffness, pc=pc)
+            df = frequency_table(tensor.dates, [s[0] for s in systems], None, [s[1] for s in systems],
+                                 sys_counts, sys_totals, val, lower, upper)
+        else:
+            df = fit_hierarchical_table(tensor, stiffness=stiffness, stiffness_minor=stiffness, mu=mu, pc=pc)
+        profiling.mark("write")
+        df.write_csv(args.output_csv, float_precision=4)
+        profiling.count("rows_written", len(df))
+    profiling.write(args.profile_json)
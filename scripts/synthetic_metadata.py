@@ -0,0 +1,154 @@
+"""
+Script to generate synthetic metadata for benchmarks
+- countries and their continents are taken from an iso3 to region table,
+  further synthetic countries are added if more are requested
+- clades form a random tree with nested names (e.g. A.1.2), each clade
+  emerges after its parent, grows logistically and carries the amino acid
+  substitutions of its parent plus new ones
+- sequence volume per country is skewed and seasonal, clade frequencies
+  vary between continents by a delay of the clade waves
+- the output has the columns used by the fit scripts (strain, date,
+  continent, iso3, region, division, proposedSubclade, clade, aaSubstitutions)
+The same seed and parameters give the same table.
+"""
+
+from datetime import date
+
+import numpy as np
+import polars as pl
+
+from . import profiling
+
+
+def synthetic_countries(n_countries, rng, regions_table="profiles/flu/iso3_to_region.tsv"):
+    """
+    `n_countries` (iso3, continent) pairs, real ones from `regions_table`
+    first and synthetic codes on the existing continents beyond that.
+    """
+    regions = pl.read_csv(regions_table, separator='\t').filter(pl.col("continent")!="Antarctica")
+    iso3, continents = regions["iso3"].to_list(), regions["continent"].to_list()
+    order = rng.permutation(len(iso3))[:n_countries]
+    countries = [(iso3[i], continents[i]) for i in order]
+    extra = rng.choice(sorted(set(continents)), size=max(0, n_countries - len(countries)))
+    countries += [(f"X{i:03d}", x) for i, x in enumerate(extra)]
+    return countries
+
+def synthetic_clades(n_clades, n_days, rng, n_roots=2):
+    """
+    Random clade tree with nested names. Returns the names, the day each
+    clade emerges, its growth rate per day and the amino acid substitutions
+    it carries (None for none).
+    """
+    names, emergence, growth, mutations = [], [], [], []
+    n_children = {}
+    for ci in range(n_clades):
+        if ci < n_roots:
+            names.append(chr(ord("A") + ci))
+            # roots are present from the start on all continents
+            emergence.append(-2.0*n_days)
+            growth.append(0.0)
+            mutations.append(set())
+        else:
+            # later clades emerge late in the time span with higher fitness
+            parent = int(rng.integers(ci))
+            n_children[parent] = n_children.get(parent, 0) + 1
+            names.append(f"{names[parent]}.{n_children[parent]}")
+            emergence.append(max(emergence[parent], 0) + rng.uniform(0.02, 0.3)*n_days)
+            growth.append(growth[parent] + rng.uniform(0.005, 0.04))
+            new = {f"HA1:{rng.choice(list('ADEGKNRST'))}{rng.integers(1, 330)}{rng.choice(list('ADEGKNRST'))}"
+                   for _ in range(rng.integers(1, 3))}
+            mutations.append(mutations[parent] | new)
+    return names, np.array(emergence), np.array(growth), [",".join(sorted(x)) or None for x in mutations]
+
+def clade_probabilities(emergence, growth, delays, n_days):
+    """
+    Cumulative clade probabilities of shape (continents, days, clades). Each
+    clade grows exponentially relative to the others from its emergence day
+    (shifted by the delay of the continent) and is absent before.
+    """
+    days = np.arange(n_days)[None,:,None] - delays[:,None,None]
+    log_weight = growth[None,None,:]*(days - emergence[None,None,:]) - np.where(days < emergence, np.inf, 0)
+    log_weight -= log_weight.max(axis=-1, keepdims=True)
+    weight = np.exp(log_weight)
+    return np.cumsum(weight/weight.sum(axis=-1, keepdims=True), axis=-1)
+
+def synthetic_metadata(n_sequences, n_countries=50, n_clades=40, n_days=730, min_date="2022-01-01",
+                       divisions=4, seed=0, chunk_size=1_000_000):
+    """
+    Generate a metadata table with `n_sequences` rows of `n_countries`
+    countries, `n_clades` nested clades and dates over `n_days` days from
+    `min_date`. Each country has up to `divisions` divisions.
+    """
+    rng = np.random.default_rng(seed)
+    countries = synthetic_countries(n_countries, rng)
+    continents = sorted(set(x[1] for x in countries))
+    country_continent = np.array([continents.index(x[1]) for x in countries])
+    names, emergence, growth, mutations = synthetic_clades(n_clades, n_days, rng)
+    cumulative = clade_probabilities(emergence, growth, rng.normal(0, 20, len(continents)), n_days)
+
+    # skewed sequencing effort per country and seasonal volume over time
+    country_weight = rng.pareto(1.2, len(countries)) + 0.05
+    day_weight = 1 + 0.7*np.sin(2*np.pi*np.arange(n_days)/365 + rng.uniform(0, 2*np.pi))
+    n_divisions = rng.integers(1, divisions + 1, len(countries))
+
+    columns = {x: [] for x in ["country", "day", "division", "clade_index"]}
+    for start in range(0, n_sequences, chunk_size):
+        n = min(chunk_size, n_sequences - start)
+        country = rng.choice(len(countries), size=n, p=country_weight/country_weight.sum())
+        day = rng.choice(n_days, size=n, p=day_weight/day_weight.sum())
+        division = rng.integers(0, n_divisions[country])
+        clade = np.empty(n, dtype=np.int64)
+        u = rng.random(n)
+        # inverse transform sampling, chunked over rows to bound the memory of the comparison
+        for sub in range(0, n, 100_000):
+            sl = slice(sub, sub + 100_000)
+            row_cumulative = cumulative[country_continent[country[sl]], day[sl]]
+            clade[sl] = np.minimum((row_cumulative < u[sl,None]).sum(axis=-1), len(names) - 1)
+        for x, values in zip(columns, [country, day, division, clade]):
+            columns[x].append(values)
+    d = pl.DataFrame({x: np.concatenate(v) if v else np.zeros(0, dtype=np.int64) for x, v in columns.items()})
+    d = d.with_row_count("index")
+
+    iso3 = pl.Series([x[0] for x in countries])
+    continent = pl.Series([x[1] for x in countries])
+    coarse = pl.Series([".".join(x.split(".")[:2]) for x in names])
+    start_date = date.fromisoformat(min_date)
+    return d.select([
+        pl.format("synthetic/{}/{}/{}", iso3.gather(d["country"]), pl.col("index"),
+                  pl.col("day")//365 + start_date.year).alias("strain"),
+        (pl.lit(start_date) + pl.duration(days=pl.col("day"))).cast(pl.Date).alias("date"),
+        continent.gather(d["country"]).alias("continent"),
+        iso3.gather(d["country"]).alias("iso3"),
+        continent.gather(d["country"]).alias("region"),
+        pl.format("{}-{}", iso3.gather(d["country"]), pl.col("division")).alias("division"),
+        pl.Series(names).gather(d["clade_index"]).alias("proposedSubclade"),
+        coarse.gather(d["clade_index"]).alias("clade"),
+        pl.Series(mutations, dtype=pl.Utf8).gather(d["clade_index"]).alias("aaSubstitutions"),
+    ])
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sequences", default=100_000, type=int, help="number of sequences")
+    parser.add_argument("--countries", default=50, type=int, help="number of countries")
+    parser.add_argument("--clades", default=40, type=int, help="number of clades")
+    parser.add_argument("--days", default=730, type=int, help="number of days covered by the sequences")
+    parser.add_argument("--min-date", default="2022-01-01", type=str, help="date of the first day")
+    parser.add_argument("--divisions", default=4, type=int, help="maximal number of divisions per country")
+    parser.add_argument("--seed", default=0, type=int, help="seed of the random number generator")
+    parser.add_argument("--output", type=str, help="output metadata tsv")
+    parser.add_argument("--profile-json", type=str, help="write timing and memory of the stages to this json file")
+
+    args = parser.parse_args()
+    if args.profile_json:
+        profiling.enable()
+
+    profiling.mark("generate")
+    d = synthetic_metadata(args.sequences, n_countries=args.countries, n_clades=args.clades, n_days=args.days,
+                           min_date=args.min_date, divisions=args.divisions, seed=args.seed)
+    profiling.mark("write")
+    d.write_csv(args.output, separator='\t')
+    profiling.count("rows_written", len(d))
+    profiling.write(args.profile_json)
+    print(f"{len(d)} sequences, {d['iso3'].n_unique()} countries, {d['proposedSubclade'].n_unique()} clades")
@@ -15,10 +15,9 @@ from os.path import dirname, join
 from typing import List, Union
 
 import polars as pl
-from PIL import Image, ImageOps
 
-from colorhash import colorhash
-from country_lookup_from_file import CountryLookupFromFile
+from . import profiling
+from .colorhash import colorhash
 
 logging.basicConfig(level=logging.INFO)
 l = logging.getLogger(" ")
@@ -29,12 +28,16 @@ def main():
     parser.add_argument("--input-pathogens-json", type=str,
                         help="Path to pathogens.json file containing a list of pathogen descriptions")
     parser.add_argument("--output-dir", type=str, help="Path to directory to output data in web format")
+    parser.add_argument("--profile-json", type=str, help="Path to json file to write timing and memory of the stages to")
     args = parser.parse_args()
+    if args.profile_json:
+        profiling.enable()
 
     input_dir = dirname(args.input_pathogens_json)
 
     input_pathogens = json_read(args.input_pathogens_json)
 
+    profiling.mark("pathogens")
     all_pathogens = []
     all_regions = set()
     all_countries = set()
@@ -46,12 +49,14 @@ def main():
             all_countries.update(set(countries))
 
     # Make index.json
+    profiling.mark("index")
     index_json = {
         "lastUpdate": date_to_iso(date_now()),
         "pathogens": all_pathogens
     }
     json_write(index_json, join(args.output_dir, "index.json"))
 
+    from .country_lookup_from_file import CountryLookupFromFile
     cl = CountryLookupFromFile("profiles/flu/iso3_to_region.tsv")
     global_geography_json = {
         "lastUpdate": date_to_iso(date_now()),
@@ -72,6 +77,7 @@ def main():
     i18n_keys.extend(all_pathogen_names)
     i18n_keys = list(sorted(set(i18n_keys)))
     json_write(i18n_keys, i18n_keys_file)
+    profiling.write(args.profile_json)
 
 
 def get_country_name(iso3_codes: pl.DataFrame, country_code: str):
@@ -80,7 +86,8 @@ def get_country_name(iso3_codes: pl.DataFrame, country_code: str):
 
 def process_one_pathogen(pathogen: dict, input_dir: str, output_dir: str):
     color = colorhash(pathogen["name"], reverse=True, prefix="321")
-    image_url = process_image(pathogen, color, input_dir, output_dir)
+    with profiling.timer("image"):
+        image_url = process_image(pathogen, color, input_dir, output_dir)
 
     l.info(f"Processing {pathogen['name']}")
 
@@ -92,7 +99,9 @@ def process_one_pathogen(pathogen: dict, input_dir: str, output_dir: str):
     regions = []
     countries = []
     if pathogen["isEnabled"]:
-        df = csv_read(join(input_dir, f'{pathogen["name"]}.csv')).sort("date")
+        with profiling.timer("read"):
+            df = csv_read(join(input_dir, f'{pathogen["name"]}.csv')).sort("date")
+        profiling.count("rows_read", len(df))
 
         condition = (pl.col('country') == '?') | (pl.col('region') == '?')
         if len(df.filter(condition)) > 0:
@@ -108,12 +117,14 @@ def process_one_pathogen(pathogen: dict, input_dir: str, output_dir: str):
         n_regions = len(regions_json["regions"])
         n_countries = len(regions_json["countries"])
         json_write(regions_json, join(output_dir, "pathogens", pathogen["name"], "geography.json"))
-        process_geography(df, pathogen, output_dir)
+        with profiling.timer("geography"):
+            process_geography(df, pathogen, output_dir)
 
         variants_json = extract_list_of_variants(df)
         n_variants = len(variants_json["variants"])
         json_write(variants_json, join(output_dir, "pathogens", pathogen["name"], "variants.json"))
-        process_variants(df, pathogen, output_dir)
+        with profiling.timer("variants"):
+            process_variants(df, pathogen, output_dir)
 
     pathogen_json = {
         **pathogen,
@@ -226,6 +237,7 @@ def process_image(pathogen, color, input_dir, output_dir):
     output_image_path = join(output_dir, "pathogens", pathogen["name"], "image.png")
     image_url = posixpath.join("pathogens", pathogen["name"], "image.png")
 
+    from PIL import Image, ImageOps
     image = Image.open(input_image_path)
     image = ImageOps.fit(image, (250, 200))
 